@@ -23,3 +23,4 @@
 __version__ = '0.1.dev'
 
 from . import markers
+from .collection import fit_markers
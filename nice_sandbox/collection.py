@@ -0,0 +1,169 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from mne.utils import logger
+
+from .utils import plan_execution, limit_threads
+
+# Attributes that reference the markers or estimators a marker depends on
+_DEPENDENCY_ATTRS = ('numerator', 'denominator', 'parent', 'estimator',
+                     'inputs')
+
+
+def _get_dependencies(marker):
+    deps = []
+    for attr in _DEPENDENCY_ATTRS:
+        # Look in vars: data_ and friends can be properties of meta markers
+        dep = vars(marker).get(attr, None)
+        if isinstance(dep, dict):
+            deps.extend(x for x in dep.values() if hasattr(x, 'fit'))
+        elif dep is not None and hasattr(dep, 'fit'):
+            deps.append(dep)
+    return deps
+
+
+def _build_graph(markers):
+    """Dependency graph of the markers and everything they reference
+
+    Returns the nodes (each object once, dependencies first when possible)
+    and, for each node id, the ids of its dependencies.
+    """
+    nodes = []
+    deps = {}
+    stack = list(reversed(list(markers)))
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in deps:
+            continue
+        node_deps = _get_dependencies(node)
+        deps[id(node)] = set(id(x) for x in node_deps)
+        nodes.append(node)
+        stack.extend(reversed(node_deps))
+    return nodes, deps
+
+
+def _get_graph_width(nodes, deps):
+    """Largest number of nodes of a dependency graph at the same depth
+
+    The nodes at the same depth do not depend on each other, so this many
+    of them can be fit at once.
+    """
+    depths = {}
+    n_missing = {id(node): len(deps[id(node)]) for node in nodes}
+    dependents = {id(node): [] for node in nodes}
+    for node in nodes:
+        for dep_id in deps[id(node)]:
+            dependents[dep_id].append(id(node))
+    ready = [id(node) for node in nodes if n_missing[id(node)] == 0]
+    for node_id in ready:
+        depths[node_id] = 0
+    while len(ready) > 0:
+        node_id = ready.pop()
+        for dependent in dependents[node_id]:
+            depths[dependent] = max(depths.get(dependent, 0),
+                                    depths[node_id] + 1)
+            n_missing[dependent] -= 1
+            if n_missing[dependent] == 0:
+                ready.append(dependent)
+    counts = {}
+    for depth in depths.values():
+        counts[depth] = counts.get(depth, 0) + 1
+    return max(list(counts.values()) + [1])
+
+
+def fit_markers(markers, epochs, n_jobs='auto'):
+    """Fit a collection of markers following their dependencies
+
+    The dependency graph is built from the ``numerator``, ``denominator``,
+    ``parent``, ``estimator`` and ``inputs`` of each marker. Every marker
+    and shared dependency (e.g. an estimator used by several markers) is fit
+    exactly once, a marker only after all its dependencies, and the
+    independent ones concurrently. The order of the collection does not
+    matter.
+
+    The markers are fit in a pool of threads, as they share their
+    dependencies by reference and the numerical work releases the GIL. The
+    BLAS threads are capped so that the pool does not oversubscribe the
+    CPUs (see ``nice_sandbox.utils.plan_execution``).
+
+    Parameters
+    ----------
+    markers : instance of Markers | list of markers
+        The markers to fit.
+    epochs : instance of Epochs
+        The epochs.
+    n_jobs : int | 'auto'
+        The number of markers fit concurrently. If 'auto', as many as can be
+        fit at once given their dependencies, up to the number of CPUs.
+
+    Returns
+    -------
+    markers : instance of Markers | list of markers
+        The fitted markers.
+    """
+    # The markers package depends on this module
+    from .markers.cache import _fit_marker
+    values = markers.values() if hasattr(markers, 'values') else markers
+    nodes, deps = _build_graph(values)
+    if n_jobs == 'auto':
+        # The CPUs are split among the markers that can be fit at once,
+        # whatever the size of the BLAS pools
+        n_workers, n_threads = plan_execution(
+            -1, n_tasks=_get_graph_width(nodes, deps))
+    else:
+        n_workers, n_threads = plan_execution(n_jobs, n_tasks=len(nodes))
+    logger.info('Fitting {} markers with {} workers'.format(
+        len(nodes), n_workers))
+
+    dependents = {id(node): [] for node in nodes}
+    for node in nodes:
+        for dep_id in deps[id(node)]:
+            dependents[dep_id].append(node)
+    n_missing = {id(node): len(deps[id(node)]) for node in nodes}
+
+    with limit_threads(n_threads), \
+            ThreadPoolExecutor(max_workers=n_workers) as executor:
+        running = {}
+        for node in nodes:
+            if n_missing[id(node)] == 0:
+                running[executor.submit(_fit_marker, node, epochs)] = node
+        n_done = 0
+        while len(running) > 0:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for pending in running:
+                        pending.cancel()
+                    raise error
+                n_done += 1
+                for dependent in dependents[id(node)]:
+                    n_missing[id(dependent)] -= 1
+                    if n_missing[id(dependent)] == 0:
+                        running[executor.submit(
+                            _fit_marker, dependent, epochs)] = dependent
+    if n_done != len(nodes):
+        raise ValueError('The dependencies of the markers are circular.')
+    return markers
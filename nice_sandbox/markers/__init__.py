@@ -22,3 +22,6 @@
 
 from . import meta
 from . import connectivity
+from .reduction import reduce_markers
+from .io import HDF5Writer, save_markers
+from .cache import fit_cache
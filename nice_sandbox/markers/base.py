@@ -20,33 +20,107 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 
-from pathlib import Path
-from mne.externals.h5io import read_hdf5, write_hdf5
-from mne.io.meas_info import Info
+from inspect import signature
 
-from nice.markers.base import BaseMarker
+from nice.markers.base import BaseMarker, BaseContainer
+from nice.collection import _markers_classes
 
+from ..utils import plan_execution, limit_threads
+from .io import HDF5Writer, LazyDataset, _read_group, _read_ch_info
+from .cache import _fit_cached
 
-class BaseMarkerSandbox(BaseMarker):
+
+class _LazyAttributes(object):
+    """Load the attributes read lazily from a file on first access"""
+
+    def __getattr__(self, name):
+        lazy = self.__dict__.get('_lazy_attrs', None)
+        if lazy is None or name not in lazy:
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                type(self).__name__, name))
+        value = lazy.pop(name).load()
+        if len(lazy) == 0:
+            del self._lazy_attrs
+        setattr(self, name, value)
+        return value
+
+    def _get_save_vars(self, exclude):
+        for name in list(self.__dict__.get('_lazy_attrs', [])):
+            getattr(self, name)
+        return super(_LazyAttributes, self)._get_save_vars(exclude=exclude)
+
+
+class BaseContainerSandbox(_LazyAttributes, BaseContainer):
+
+    def _get_title(self):
+        return _get_title(self.__class__, self.comment)
+
+    # Whether the fitted attributes can be reused from a fit_cache
+    _cache_fit = True
+
+    def save(self, fname, overwrite=False, storage=None):
+        with HDF5Writer(fname, overwrite=overwrite,
+                        storage=storage) as writer:
+            writer.add(self)
+
+    def _get_save_group(self):
+        # Title and variables of the HDF5 group (see HDF5Writer)
+        return self._get_title(), self._get_save_vars(exclude=['ch_info_'])
+
+
+class BaseMarkerSandbox(_LazyAttributes, BaseMarker):
 
     def _get_title(self):
         return _get_title(self.__class__, self.comment)
 
-    def save(self, fname, overwrite=False):
-        if not isinstance(fname, Path):
-            fname = Path(fname)
-        self._save_info(fname, overwrite=overwrite)
-        save_vars = self._get_save_vars(exclude=['ch_info_'])
-        write_hdf5(
-            fname,
-            save_vars,
-            title=_get_title(self.__class__, self.comment),
-            overwrite=overwrite, slash='replace')
+    # Whether the fitted attributes can be reused from a fit_cache
+    _cache_fit = True
+
+    def fit(self, epochs):
+        if self._cache_fit:
+            return _fit_cached(self, epochs, self._fit_uncached)
+        return self._fit_uncached(epochs)
+
+    def _fit_uncached(self, epochs):
+        # Cap the BLAS threads to the usable CPUs to avoid oversubscription
+        _, n_threads = self._plan_execution()
+        with limit_threads(n_threads):
+            BaseMarker.fit(self, epochs)
+        return self
+
+    def _plan_execution(self):
+        # (n_procs, n_threads). By default, markers run in this process.
+        return plan_execution(1)
+
+    def _reduce_to(self, reduction_func, target, picks):
+        dataset = self.__dict__.get('_lazy_attrs', {}).get('data_', None)
+        if dataset is None or not self._can_reduce_from_disk():
+            return BaseMarker._reduce_to(self, reduction_func, target, picks)
+        # Reduce the data while reading it, without loading all of it
+        from .reduction import _get_reduction_plan, _reduce_dataset
+        plan = _get_reduction_plan(self, reduction_func, target)
+        return _reduce_dataset(plan, dataset, self._axis_map, picks,
+                               self._get_preserve_axis(target))
+
+    def _can_reduce_from_disk(self):
+        # Whether _prepare_data only picks data_
+        return type(self)._prepare_data is BaseMarker._prepare_data
+
+    def save(self, fname, overwrite=False, storage=None):
+        with HDF5Writer(fname, overwrite=overwrite,
+                        storage=storage) as writer:
+            writer.add(self)
+
+    def _get_save_group(self):
+        # Title and variables of the HDF5 group (see HDF5Writer)
+        return self._get_title(), self._get_save_vars(exclude=['ch_info_'])
 
 
 def _get_title(klass, comment):
     if issubclass(klass, BaseMarker):
         kind = 'marker'
+    elif issubclass(klass, BaseContainer):
+        kind = 'container'
     else:
         raise NotImplementedError('Oh no-- what is this?')
     _title = '/'.join([
@@ -54,16 +128,64 @@ def _get_title(klass, comment):
     return _title
 
 
-def _read_container(klass, fname, comment='default'):
-    data = read_hdf5(fname,  _get_title(klass, comment), slash='replace')
+def _get_comment(title):
+    # Inverse of _get_title: 'nice_sandbox/kind/klass/comment'
+    return title.split('/', 3)[-1]
+
+
+def _is_fitted(marker):
+    # Meta markers can tell without computing their data_
+    if hasattr(marker, 'is_fitted'):
+        return marker.is_fitted()
+    # Without loading data_ if it was read lazily
+    return ('data_' in vars(marker).get('_lazy_attrs', {}) or
+            hasattr(marker, 'data_'))
+
+
+def _read_marker(fname, title, markers, lazy=False):
+    """Read the marker with this title, and the markers it depends on
+
+    ``markers`` maps titles to the markers already read, which are reused,
+    and gets the ones read here, so that a marker shared by several others
+    is read once. ``lazy`` is passed to the readers that support it.
+    """
+    if title not in markers:
+        class_name, comment = title.split('/', 3)[2:]
+        if class_name not in _markers_classes:
+            raise ValueError('Cannot read {}: {} is not a registered marker '
+                             'class.'.format(title, class_name))
+        klass = _markers_classes[class_name]
+        params = signature(klass._read).parameters
+        kwargs = dict(comment=comment)
+        if 'markers' in params:
+            # Markers with dependencies read them with the same markers
+            kwargs['markers'] = markers
+        if 'lazy' in params:
+            kwargs['lazy'] = lazy
+        marker = klass._read(fname, **kwargs)
+        markers[title] = marker
+    return markers[title]
+
+
+def _read_container(klass, fname, comment='default', lazy=False):
+    """Read a container or marker
+
+    If lazy, its arrays (e.g. ``data_``) are not read: they are memory mapped
+    from the file, or read from it, when first accessed, and markers are
+    reduced reading their data slab by slab. The file must not be modified
+    while the marker is used.
+    """
+    data = _read_group(fname, _get_title(klass, comment), lazy=lazy)
     init_params = {k: v for k, v in data.items() if not k.endswith('_')}
     attrs = {k: v for k, v in data.items() if k.endswith('_')}
-    file_info = read_hdf5(fname, title='nice/data/ch_info', slash='replace')
-    if 'filename' in file_info:
-        del(file_info['filename'])
-    attrs['ch_info_'] = Info(file_info)
+    attrs['ch_info_'] = _read_ch_info(fname)
     out = klass(**init_params)
+    lazy_attrs = {}
     for k, v in attrs.items():
-        if k.endswith('_'):
+        if isinstance(v, LazyDataset):
+            lazy_attrs[k] = v
+        elif k.endswith('_'):
             setattr(out, k, v)
+    if len(lazy_attrs) > 0:
+        out._lazy_attrs = lazy_attrs
     return out
@@ -0,0 +1,262 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import weakref
+
+import numpy as np
+
+from mne.utils import logger
+from mne.externals.h5io import read_hdf5, write_hdf5
+
+from .. import __version__
+from ..collection import _get_dependencies, _DEPENDENCY_ATTRS
+from ..utils import _parse_memory
+
+# Cache used by the fits, set by the innermost fit_cache
+_fit_cache = [None]
+
+_CACHE_TITLE = 'nice_sandbox/fit_cache'
+
+# Channel info entries that the markers depend on
+_INFO_KEYS = ('ch_names', 'sfreq', 'bads', 'highpass', 'lowpass')
+
+
+class FitCache(object):
+    """Fitted attributes of markers, stored by content in a directory
+
+    The key of a fit hashes the data, times and channel info of the epochs,
+    the class of the marker, its parameters and, recursively, the ones of
+    the estimators and markers it depends on. The epochs are hashed once
+    per cache, so they must not be modified in place while it is used.
+
+    Each entry is an HDF5 file of the fitted attributes (ending with _).
+    When the entries take more than ``max_size``, the least recently used
+    ones are removed.
+
+    Parameters
+    ----------
+    path : str | Path
+        The cache directory. It is created if needed.
+    max_size : int | str
+        The size of the cache, in bytes or as '10G', '512M'...
+    """
+
+    def __init__(self, path, max_size='10G'):
+        self.path = Path(path)
+        self.max_size = _parse_memory(max_size)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # By id, as Epochs hash their data. Entries are dropped with them.
+        self._epochs_keys = dict()
+
+    def get_key(self, marker, epochs):
+        """The key of fitting the marker to the epochs"""
+        hasher = hashlib.blake2b(digest_size=20)
+        _hash_value(hasher, __version__)
+        _hash_value(hasher, self._get_epochs_key(epochs))
+        _hash_marker(hasher, marker)
+        return hasher.hexdigest()
+
+    def _get_epochs_key(self, epochs):
+        with self._lock:
+            key = self._epochs_keys.get(id(epochs), None)
+        if key is None:
+            hasher = hashlib.blake2b(digest_size=20)
+            _hash_value(hasher, epochs.times)
+            _hash_value(hasher, [epochs.info.get(k) for k in _INFO_KEYS])
+            data = getattr(epochs, '_data', None)
+            if data is None or not getattr(epochs, 'preload', False):
+                data = epochs.get_data()
+            _hash_value(hasher, data)
+            key = hasher.hexdigest()
+            with self._lock:
+                self._epochs_keys[id(epochs)] = key
+            weakref.finalize(epochs, self._forget_epochs, id(epochs))
+        return key
+
+    def _forget_epochs(self, epochs_id):
+        with self._lock:
+            self._epochs_keys.pop(epochs_id, None)
+
+    def _get_fname(self, key):
+        return self.path / '{}.hdf5'.format(key)
+
+    def load(self, marker, key):
+        """Set the cached fitted attributes on the marker, if any"""
+        fname = self._get_fname(key)
+        if not fname.exists():
+            return False
+        try:
+            attrs = read_hdf5(str(fname), title=_CACHE_TITLE,
+                              slash='replace')
+        except (IOError, OSError, ValueError) as err:
+            logger.warning('Ignoring the cached fit {}: {}'.format(
+                fname, err))
+            return False
+        for name, value in attrs.items():
+            setattr(marker, name, value)
+        # Most recently used
+        os.utime(str(fname))
+        logger.info('Using the cached fit of {}'.format(marker._get_title()))
+        return True
+
+    def store(self, marker, key):
+        """Store the fitted attributes of the marker"""
+        attrs = {k: v for k, v in vars(marker).items()
+                 if k.endswith('_') and k != 'ch_info_'}
+        fname = self._get_fname(key)
+        # Written aside and moved, so that no fit reads a partial entry
+        tmp_fname = fname.with_suffix('.{}.{}.tmp'.format(
+            os.getpid(), threading.get_ident()))
+        write_hdf5(str(tmp_fname), attrs, title=_CACHE_TITLE,
+                   overwrite=True, slash='replace')
+        os.replace(str(tmp_fname), str(fname))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for fname in self.path.glob('*.hdf5'):
+                try:
+                    stat = fname.stat()
+                except OSError:
+                    # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+            size = sum(x[1] for x in entries)
+            for _, entry_size, fname in sorted(entries):
+                if size <= self.max_size:
+                    break
+                try:
+                    fname.unlink()
+                except OSError:
+                    pass
+                size -= entry_size
+
+
+def _hash_value(hasher, value):
+    """Update the hash with a parameter, array or container of them"""
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        hasher.update(repr((value.dtype.str, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif isinstance(value, np.ndarray):
+        _hash_value(hasher, value.tolist())
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for key in sorted(value, key=repr):
+            _hash_value(hasher, key)
+            _hash_value(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode())
+        for item in value:
+            _hash_value(hasher, item)
+    elif callable(value):
+        hasher.update('{}.{}'.format(
+            getattr(value, '__module__', ''),
+            getattr(value, '__qualname__', repr(value))).encode())
+    else:
+        hasher.update(repr(value).encode())
+
+
+def _hash_marker(hasher, marker):
+    # The class, the parameters and, recursively, the dependencies
+    deps = _get_dependencies(marker)
+    klass = type(marker)
+    hasher.update('{}.{}'.format(klass.__module__,
+                                 klass.__qualname__).encode())
+    # The comment only names the marker, and the resources used to fit it
+    # do not change the result
+    params = marker._get_save_vars(
+        exclude=list(_DEPENDENCY_ATTRS) + ['comment', 'n_jobs',
+                                           'max_memory'])
+    _hash_value(hasher, {k: v for k, v in params.items()
+                         if not k.endswith('_') and not k.startswith('_')})
+    for dep in deps:
+        _hash_marker(hasher, dep)
+
+
+def _get_fit_cache():
+    return _fit_cache[0]
+
+
+def _fit_cached(marker, epochs, fit):
+    """Fit a marker with ``fit(epochs)``, unless it is in the fit cache
+
+    On a cache hit, the dependencies of the marker that are not fit (e.g.
+    its estimator) are fit, or loaded from the cache, as the fit would have
+    done.
+    """
+    from .base import _is_fitted
+    cache = _get_fit_cache()
+    if cache is None:
+        fit(epochs)
+        return marker
+    key = cache.get_key(marker, epochs)
+    if cache.load(marker, key):
+        marker.ch_info_ = epochs.info
+        for dep in _get_dependencies(marker):
+            if not _is_fitted(dep):
+                _fit_marker(dep, epochs)
+        return marker
+    fit(epochs)
+    cache.store(marker, key)
+    return marker
+
+
+def _fit_marker(marker, epochs):
+    """Fit a marker or estimator, through the fit cache for nice ones"""
+    if hasattr(marker, '_cache_fit'):
+        # Ours look in the cache themselves
+        return marker.fit(epochs)
+    return _fit_cached(marker, epochs, marker.fit)
+
+
+@contextmanager
+def fit_cache(path, max_size='10G'):
+    """Reuse the fits of the markers to the same epochs
+
+    Within this context, fitting a marker or an estimator first looks for
+    its fitted attributes in the cache directory, and skips the fit if they
+    are there. Otherwise it is fit and its attributes are added to the
+    cache. The meta markers, which keep no data of their own, are always
+    fit. The markers and estimators from nice are cached when they are fit
+    by ``fit_markers`` or by the markers that depend on them.
+
+    Parameters
+    ----------
+    path : str | Path
+        The cache directory. It is created if needed.
+    max_size : int | str
+        The size of the cache, in bytes or as '10G', '512M'... The least
+        recently used fits are removed first.
+    """
+    previous = _fit_cache[0]
+    _fit_cache[0] = FitCache(path, max_size=max_size)
+    try:
+        yield _fit_cache[0]
+    finally:
+        _fit_cache[0] = previous
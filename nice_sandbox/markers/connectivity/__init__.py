@@ -20,9 +20,11 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 
+from . estimator import CrossSpectralEstimator, read_csd_estimator
 from . wpli import WeightedPhaseLagIndex, read_wpli
 from . plv import PhaseLockingValue, read_plv
 from nice.collection import register_marker_class
 
 register_marker_class(WeightedPhaseLagIndex)
 register_marker_class(PhaseLockingValue)
+register_marker_class(CrossSpectralEstimator)
@@ -0,0 +1,658 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+
+import numpy as np
+from collections import OrderedDict
+
+import mne
+from mne.utils import logger
+
+from ...markers.base import (BaseMarkerSandbox, _read_container,
+                             _read_marker)
+from ...markers.cache import _fit_marker
+from ...utils import plan_execution, limit_threads, _parse_memory
+from .engine import (_compute_spectra, _compute_csd, _get_chunk_size,
+                     _get_epochs_data, _check_time_window, _sliding_windows,
+                     _get_pair_blocks, _CSD_CHUNK_BYTES)
+
+
+class BaseConnectivity(BaseMarkerSandbox):
+    """Base class for the spectral connectivity markers
+
+    Subclasses define the connectivity method by implementing the
+    ``_accumulate`` and ``_compute_con`` hooks. ``_accumulate`` receives
+    the cross-spectral densities of a chunk of epochs, with shape
+    (n_epochs, n_freqs, n_seeds, n_targets), and sums them over epochs.
+    ``_compute_epoch_con`` returns the single-trial estimates of the
+    cross-spectral densities of one band, averaged over its frequencies.
+    They must be linear quantities that can be averaged over epochs (no
+    angles), and are antisymmetric if ``_epoch_con_antisymmetric`` is True.
+
+    The spectra are computed with the vectorized engine unless
+    ``method_params['engine']`` is ``'mne'``, in which case
+    ``mne.connectivity.spectral_connectivity`` is used. The spectral method
+    and its parameters are also set in ``method_params`` (see
+    ``engine._compute_spectra``): ``'multitaper'`` (default), ``'fourier'``,
+    ``'welch'`` or ``'cwt_morlet'``. The mne engine only supports the
+    first two.
+
+    Only the samples between ``tmin`` and ``tmax`` are transformed. With an
+    estimator, the time window is the one of the estimator.
+
+    If ``bands`` is a list of (fmin, fmax) tuples, the connectivity of
+    every band is computed from the same spectra and ``data_`` gets a
+    ``frequency`` axis with one entry per band. Otherwise, the connectivity
+    is averaged between ``fmin`` and ``fmax``.
+
+    If ``packed`` is True, ``data_`` only keeps the upper triangle of the
+    symmetric connectivity matrix, with shape (n_pairs, ...). The pairs are
+    ordered as in ``np.triu_indices(n_channels, 1)``. ``_axis_map`` still
+    describes the full matrix, which is expanded only for the picked
+    channels when reducing.
+
+    ``seeds`` and ``targets`` restrict the computation to the connectivity
+    between these two sets of channel indices (all the channels if None).
+    ``data_`` then has shape (n_seeds, n_targets, ...): the ``channels``
+    axis indexes the seeds and the ``channels_y`` axis the targets. Use the
+    same channels as seeds and targets for a ROI.
+
+    If ``window_length`` is set (in seconds), the connectivity is computed
+    in sliding windows of that length, ``window_step`` seconds apart
+    (consecutive windows overlap by ``window_length - window_step``). The
+    windows are strided views of the data and are transformed in one batch.
+    ``data_`` then gets a last ``times`` axis and ``times_`` holds the
+    center of each window. A continuous recording can be passed as a single
+    long epoch. Only available with the native engine.
+
+    If ``per_epoch`` is True, the single-trial estimates are kept instead of
+    their average and ``data_`` gets a leading ``epochs`` axis, so that the
+    epochs can be reduced or rejected without refitting. They are stored
+    as ``dtype`` (float32 by default). Not available with the mne engine.
+    Only for the methods with a single-trial estimate (not the PLV, which is
+    only defined across epochs).
+
+    ``max_memory`` (bytes, or a string such as ``'2G'``) bounds the memory
+    used for the cross-spectral densities and their sums over epochs. The
+    channel pairs are tiled into blocks that are computed over chunks of
+    epochs and reduced to ``data_`` one after the other, with the same
+    output as without blocks. For symmetric connectivity (same seeds and
+    targets), only the blocks above the diagonal are computed. The spectra
+    of the epochs are not included, use ``partial_fit`` with chunks of
+    epochs to bound them. ``partial_fit`` keeps the sums of all the blocks
+    between calls, though, so ``max_memory`` then only bounds the
+    cross-spectral densities of each chunk.
+
+    ``n_jobs`` is the number of processes of the mne engine (``'auto'``
+    lets ``nice_sandbox.utils.plan_execution`` choose it). The native
+    engine runs in this process, with the BLAS threads capped to the CPUs
+    available to it.
+    """
+
+    _method = None
+
+    # Whether the single-trial estimates change sign with the channel order
+    _epoch_con_antisymmetric = False
+
+    def __init__(self, tmin=None, tmax=None, fmin=None, fmax=None,
+                 method_params=None, n_jobs='auto', estimator=None,
+                 bands=None, packed=False, seeds=None, targets=None,
+                 window_length=None, window_step=None, per_epoch=False,
+                 dtype='float32', max_memory=None, comment='default'):
+        _check_time_window(tmin, tmax)
+        BaseMarkerSandbox.__init__(
+            self, tmin=tmin, tmax=tmax, comment=comment)
+        if method_params is None:
+            method_params = {}
+        if fmax is None:
+            fmax = np.inf
+        if bands is not None:
+            if fmin is not None or np.isfinite(fmax):
+                raise ValueError('Specify either bands or fmin/fmax, '
+                                 'not both.')
+            bands = [tuple(band) for band in bands]
+            if any(len(band) != 2 or band[0] >= band[1] for band in bands):
+                raise ValueError('Bands must be (fmin, fmax) tuples with '
+                                 'fmin < fmax.')
+        if seeds is not None:
+            seeds = [int(x) for x in seeds]
+        if targets is not None:
+            targets = [int(x) for x in targets]
+        if packed and seeds != targets:
+            raise ValueError('A packed matrix needs the same seeds and '
+                             'targets.')
+        if per_epoch and (type(self)._compute_epoch_con is
+                          BaseConnectivity._compute_epoch_con):
+            raise ValueError('Per epoch connectivity is not available for '
+                             '{}.'.format(type(self).__name__))
+        if window_length is None and window_step is not None:
+            raise ValueError('window_step needs a window_length.')
+        if window_length is not None:
+            if window_step is None:
+                window_step = window_length
+            if window_length <= 0 or window_step <= 0:
+                raise ValueError('window_length and window_step must be '
+                                 'positive.')
+        if max_memory is not None:
+            _parse_memory(max_memory)
+        self.fmin = fmin
+        self.fmax = fmax
+        self.method_params = method_params
+        self.n_jobs = n_jobs
+        self.estimator = estimator
+        self.bands = bands
+        self.packed = packed
+        self.seeds = seeds
+        self.targets = targets
+        self.window_length = window_length
+        self.window_step = window_step
+        self.per_epoch = per_epoch
+        self.dtype = np.dtype(dtype).name
+        self.max_memory = max_memory
+
+    @property
+    def _axis_map(self):
+        axis_map = OrderedDict()
+        if self.per_epoch:
+            axis_map['epochs'] = 0
+        axis_map['channels'] = len(axis_map)
+        axis_map['channels_y'] = len(axis_map)
+        if self.bands is not None:
+            axis_map['frequency'] = len(axis_map)
+        if self.window_length is not None:
+            axis_map['times'] = len(axis_map)
+        return axis_map
+
+    def _can_reduce_from_disk(self):
+        return not self.packed
+
+    def _prepare_data(self, picks, target):
+        if not self.packed:
+            return BaseMarkerSandbox._prepare_data(self, picks, target)
+        if picks is None:
+            picks = {}
+        if any([x not in self._axis_map for x in picks.keys()]):
+            raise ValueError('Picking is not compatible for {}'.format(
+                self._get_title()))
+        to_preserve = self._get_preserve_axis(target)
+        ch_picks = [None, None]
+        for i_axis, axis in enumerate(['channels', 'channels_y']):
+            if axis not in to_preserve:
+                ch_picks[i_axis] = picks.get(axis, None)
+        data = self.data_
+        if self.per_epoch:
+            data = np.moveaxis(data, 0, -1)
+        n_pairs = len(data)
+        n_channels = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+        data = _unpack_triu(
+            data, n_channels, *ch_picks,
+            antisymmetric=self.per_epoch and self._epoch_con_antisymmetric)
+        if self.per_epoch:
+            data = np.moveaxis(data, -1, 0)
+        for axis, ax_picks in picks.items():
+            if (axis in to_preserve or ax_picks is None or
+                    axis in ['channels', 'channels_y']):
+                continue
+            this_axis = self._axis_map[axis]
+            data = (data.swapaxes(this_axis, 0)[ax_picks, ...]
+                    .swapaxes(0, this_axis))
+        return data
+
+    def _get_seeds_targets(self, n_channels):
+        seeds = self.seeds
+        if seeds is None:
+            seeds = np.arange(n_channels)
+        targets = self.targets
+        if targets is None:
+            targets = np.arange(n_channels)
+        return np.asarray(seeds), np.asarray(targets)
+
+    def _get_freq_range(self):
+        if self.bands is not None:
+            return (min(band[0] for band in self.bands),
+                    max(band[1] for band in self.bands))
+        return self.fmin, self.fmax
+
+    def _plan_execution(self):
+        if self.method_params.get('engine', 'native') == 'mne':
+            return plan_execution(self.n_jobs)
+        # The native engine runs in this process, with multithreaded BLAS
+        return plan_execution(self.n_jobs, n_tasks=1)
+
+    def _fit(self, epochs):
+        engine = self.method_params.get('engine', 'native')
+        if self.estimator is not None:
+            if ((self.tmin is not None or self.tmax is not None) and
+                    (self.tmin, self.tmax) != (self.estimator.tmin,
+                                               self.estimator.tmax)):
+                raise ValueError('The time window of the marker and the '
+                                 'estimator differ. Set it in the '
+                                 'estimator.')
+            if self.window_length is not None:
+                raise ValueError('Sliding windows cannot be used with an '
+                                 'estimator.')
+            if not hasattr(self.estimator, 'data_'):
+                logger.info('Cross spectral estimator not fit. '
+                            'Fitting it now.')
+                _fit_marker(self.estimator, epochs)
+            fmin, fmax = self._get_freq_range()
+            fmin = -np.inf if fmin is None else fmin
+            # The frequencies are sorted: a slice is a view of the spectra
+            # of the estimator, shared by all the markers fit from it
+            freqs = self.estimator.freqs_
+            freq_slice = slice(np.searchsorted(freqs, fmin, 'left'),
+                               np.searchsorted(freqs, fmax, 'right'))
+            if freq_slice.start == freq_slice.stop:
+                raise ValueError('There are no frequency points between '
+                                 '{}Hz and {}Hz in the estimator.'.format(
+                                     fmin, fmax))
+            self._fit_spectra(self.estimator.data_[..., freq_slice],
+                              freqs[freq_slice], self.estimator.n_tapers_)
+        elif engine == 'native':
+            self._fit_spectra(*self._compute_spectra(epochs))
+        elif engine == 'mne':
+            self._fit_mne(epochs)
+        else:
+            raise ValueError('Unknown connectivity engine: {}'.format(engine))
+
+    def _fit_mne(self, epochs):
+        # Reference implementation
+        fmin, fmax = self.fmin, self.fmax
+        if self.bands is not None:
+            fmin, fmax = zip(*self.bands)
+        if self.window_length is not None:
+            raise ValueError('Sliding windows are only available with the '
+                             'native engine.')
+        if self.per_epoch:
+            raise ValueError('Per epoch connectivity is only available with '
+                             'the native engine.')
+        mode = self.method_params.get('mode', 'multitaper')
+        if mode not in ('multitaper', 'fourier'):
+            raise ValueError('The {} mode is only available with the native '
+                             'engine.'.format(mode))
+        mode_params = {k: v for k, v in self.method_params.items()
+                       if k in ('mt_bandwidth', 'mt_adaptive', 'mt_low_bias')}
+        indices = None
+        if self.seeds is not None or self.targets is not None:
+            seeds, targets = self._get_seeds_targets(
+                len(epochs.info['ch_names']))
+            indices = (np.repeat(seeds, len(targets)),
+                       np.tile(targets, len(seeds)))
+        n_procs, _ = self._plan_execution()
+        # Cropped here, as for the native engine: spectral_connectivity
+        # takes the times of the epochs to start at 0
+        epochs_data, _ = _get_epochs_data(epochs, self.tmin, self.tmax)
+        data, freqs, times, n_epochs, n_tappers = \
+            mne.connectivity.spectral_connectivity(
+                epochs_data, method=self._method, indices=indices,
+                sfreq=epochs.info['sfreq'], mode=mode, fmin=fmin,
+                fmax=fmax, faverage=True, n_jobs=n_procs, **mode_params)
+        if indices is not None:
+            data = data.reshape(len(seeds), len(targets), -1)
+            data[np.equal.outer(seeds, targets)] = 0.
+            if self.bands is None:
+                data = data[..., 0]
+                freqs = freqs[0]
+            else:
+                freqs = np.unique(np.concatenate(freqs))
+            self.data_ = data
+            self.freqs_ = freqs
+        elif self.bands is None:
+            self.data_ = np.squeeze(data)
+            self.data_ += self.data_.T
+            self.freqs_ = freqs[0]
+        else:
+            self.data_ = data + data.transpose(1, 0, 2)
+            self.freqs_ = np.unique(np.concatenate(freqs))
+        if self.packed:
+            self.data_ = _pack_triu(self.data_)
+        self.times_ = times
+        self.n_epochs_ = n_epochs
+        self.n_tappers_ = n_tappers
+
+    def partial_fit(self, epochs):
+        """Accumulate the connectivity of a chunk of epochs
+
+        Only the running sums are kept between calls, so memory is bounded
+        by the size of the chunk. The sums of all the channel pairs and
+        frequencies are kept, whatever ``max_memory``. Call ``finalize``
+        once all the chunks have been seen to compute ``data_``.
+
+        Parameters
+        ----------
+        epochs : instance of Epochs
+            The chunk of epochs. All chunks must have the same channels,
+            sampling frequency and number of samples.
+
+        Returns
+        -------
+        self : instance of BaseConnectivity
+            The marker.
+        """
+        if self.estimator is not None:
+            raise ValueError('Cannot use partial_fit with an estimator.')
+        if self.method_params.get('engine', 'native') != 'native':
+            raise ValueError('partial_fit is only available with the '
+                             'native engine.')
+        _, n_threads = self._plan_execution()
+        with limit_threads(n_threads):
+            spectra, freqs, n_tapers, times = self._compute_spectra(epochs)
+        state = getattr(self, '_partial_state', None)
+        if state is None:
+            self.ch_info_ = epochs.info
+            state = dict(acc=None, n_epochs=0, freqs=freqs,
+                         n_tapers=n_tapers, n_channels=spectra.shape[-3],
+                         times=times)
+            self._partial_state = state
+        elif (epochs.info['ch_names'] != self.ch_info_['ch_names'] or
+              not np.array_equal(freqs, state['freqs'])):
+            raise ValueError('The chunk of epochs does not match the '
+                             'previous ones.')
+        with limit_threads(n_threads):
+            state['acc'] = self._accumulate_spectra(state['acc'], spectra,
+                                                    freqs)
+        state['n_epochs'] += len(spectra)
+        return self
+
+    def finalize(self):
+        """Compute ``data_`` from the chunks passed to ``partial_fit``
+
+        Returns
+        -------
+        self : instance of BaseConnectivity
+            The marker.
+        """
+        state = getattr(self, '_partial_state', None)
+        if state is None:
+            raise ValueError('Nothing to finalize. Call partial_fit first.')
+        if self.per_epoch:
+            self._set_epoch_con(
+                np.concatenate(state['acc']), state['freqs'],
+                state['n_tapers'], state['n_channels'], state['times'])
+        else:
+            band_masks = self._get_band_masks(state['freqs'])
+            con = None
+            for block, block_acc in state['acc'].items():
+                con = self._set_block_con(
+                    con, block, self._compute_block_con(
+                        block_acc, state['n_epochs'], band_masks),
+                    state['n_channels'])
+            self._set_con(con, state['freqs'], state['n_epochs'],
+                          state['n_tapers'], state['n_channels'],
+                          state['times'])
+        del self._partial_state
+        return self
+
+    def _compute_spectra(self, epochs):
+        sfreq = epochs.info['sfreq']
+        data, times = _get_epochs_data(epochs, self.tmin, self.tmax)
+        window_times = None
+        if self.window_length is not None:
+            n_per_window = int(round(self.window_length * sfreq))
+            n_step = max(int(round(self.window_step * sfreq)), 1)
+            if not 0 < n_per_window <= data.shape[-1]:
+                raise ValueError('The windows ({} samples) do not fit in '
+                                 'the epochs ({} samples).'.format(
+                                     n_per_window, data.shape[-1]))
+            # (n_epochs, n_windows, n_channels, n_per_window), zero-copy
+            data = np.moveaxis(
+                _sliding_windows(data, n_per_window, n_step), -2, 1)
+            window_times = (times[0] + (np.arange(data.shape[1]) * n_step +
+                                        (n_per_window - 1) / 2.) / sfreq)
+        fmin, fmax = self._get_freq_range()
+        spectra, freqs, n_tapers = _compute_spectra(
+            data, sfreq, fmin=fmin, fmax=fmax,
+            method_params=self.method_params)
+        return spectra, freqs, n_tapers, window_times
+
+    def _get_max_bytes(self):
+        if self.max_memory is None:
+            return _CSD_CHUNK_BYTES
+        return _parse_memory(self.max_memory)
+
+    def _get_blocks(self, spectra, triu):
+        seeds, targets = self._get_seeds_targets(spectra.shape[-3])
+        pair_bytes = int(np.prod(spectra.shape[1:-3])) * spectra.shape[-1] * 16
+        return _get_pair_blocks(len(seeds), len(targets), pair_bytes,
+                                self._get_max_bytes(), triu=triu)
+
+    def _iter_block_csd(self, spectra, block):
+        """Cross-spectral densities of a block of pairs, by chunks of epochs
+
+        Yields the index of the first epoch of each chunk and the
+        cross-spectral densities, with shape
+        (n_chunk_epochs, ..., n_freqs, n_block_seeds, n_block_targets).
+        """
+        n_epochs, n_channels = len(spectra), spectra.shape[-3]
+        seeds, targets = self._get_seeds_targets(n_channels)
+        seed_start, seed_stop, target_start, target_stop = block
+        take_x = (self.seeds is not None or
+                  (seed_start, seed_stop) != (0, n_channels))
+        take_y = (self.targets is not None or
+                  (target_start, target_stop) != (0, n_channels))
+        pair_bytes = int(np.prod(spectra.shape[1:-3])) * spectra.shape[-1] * 16
+        step = _get_chunk_size(
+            pair_bytes * (seed_stop - seed_start) *
+            (target_stop - target_start), n_epochs, self._get_max_bytes())
+        for start in range(0, n_epochs, step):
+            # Copy only the channels of the block for this chunk of epochs
+            spectra_x = spectra_y = spectra[start:start + step]
+            if take_x:
+                spectra_x = np.take(spectra_x, seeds[seed_start:seed_stop],
+                                    axis=-3)
+            if take_y:
+                spectra_y = np.take(
+                    spectra_y, targets[target_start:target_stop], axis=-3)
+            yield start, _compute_csd(spectra_x, spectra_y)
+
+    def _accumulate_spectra(self, acc, spectra, freqs):
+        """Accumulate the connectivity of the spectra of some epochs
+
+        For the average connectivity, ``acc`` maps each block of channel
+        pairs, as (seed_start, seed_stop, target_start, target_stop), to its
+        running sums. For the single-trial connectivity, it is the list of
+        the connectivity of each call.
+        """
+        n_channels = spectra.shape[-3]
+        seeds, targets = self._get_seeds_targets(n_channels)
+        if self.per_epoch:
+            blocks = self._get_blocks(spectra, triu=self.packed)
+            band_masks = self._get_band_masks(freqs)
+            # (n_epochs, [n_windows], n_bands, n_seeds, n_targets)
+            out = np.zeros(spectra.shape[:-3] + (len(band_masks), len(seeds),
+                                                 len(targets)),
+                           dtype=self.dtype)
+            acc = [] if acc is None else acc
+            acc.append(out)
+            for block in blocks:
+                seed_start, seed_stop, target_start, target_stop = block
+                for start, csd in self._iter_block_csd(spectra, block):
+                    out[start:start + len(csd), ..., seed_start:seed_stop,
+                        target_start:target_stop] = np.stack(
+                        [self._compute_epoch_con(csd[..., mask, :, :])
+                         for mask in band_masks], axis=-3)
+            return acc
+
+        if acc is None:
+            acc = {}
+        for block in self._get_blocks(spectra, triu=self._is_symmetric()):
+            for _, csd in self._iter_block_csd(spectra, block):
+                acc[block] = self._accumulate(acc.get(block), csd)
+        return acc
+
+    def _is_symmetric(self):
+        # The connectivity of (x, y) and (y, x) is the same
+        return self.seeds == self.targets
+
+    def _compute_block_con(self, block_acc, n_epochs, band_masks):
+        # ([n_windows], n_freqs, ...) sums to ([n_windows], n_bands, ...)
+        block_con = self._compute_con(block_acc, n_epochs)
+        return np.stack([block_con[..., mask, :, :].mean(axis=-3)
+                         for mask in band_masks], axis=-3)
+
+    def _set_block_con(self, con, block, block_con, n_channels):
+        """Write the connectivity of a block of pairs in con
+
+        con is allocated at the first block. Only the blocks above the
+        diagonal are computed for symmetric connectivity, they are mirrored
+        below it.
+        """
+        seed_start, seed_stop, target_start, target_stop = block
+        if con is None:
+            seeds, targets = self._get_seeds_targets(n_channels)
+            con = np.zeros(block_con.shape[:-2] + (len(seeds), len(targets)),
+                           dtype=block_con.dtype)
+        con[..., seed_start:seed_stop, target_start:target_stop] = block_con
+        if (self._is_symmetric() and
+                (seed_start, seed_stop) != (target_start, target_stop)):
+            con[..., target_start:target_stop, seed_start:seed_stop] = \
+                block_con.swapaxes(-1, -2)
+        return con
+
+    def _fit_spectra(self, spectra, freqs, n_tapers, times=None):
+        n_epochs, n_channels = len(spectra), spectra.shape[-3]
+        if self.per_epoch:
+            acc = self._accumulate_spectra(None, spectra, freqs)
+            self._set_epoch_con(np.concatenate(acc), freqs, n_tapers,
+                                n_channels, times)
+            return
+        # Sum the epochs of each block of pairs and reduce it right away,
+        # so that only one block of sums is kept in memory
+        band_masks = self._get_band_masks(freqs)
+        con = None
+        for block in self._get_blocks(spectra, triu=self._is_symmetric()):
+            block_acc = None
+            for _, csd in self._iter_block_csd(spectra, block):
+                block_acc = self._accumulate(block_acc, csd)
+            del csd
+            con = self._set_block_con(
+                con, block,
+                self._compute_block_con(block_acc, n_epochs, band_masks),
+                n_channels)
+        self._set_con(con, freqs, n_epochs, n_tapers, n_channels, times)
+
+    def _get_band_masks(self, freqs):
+        if self.bands is None:
+            return [np.ones(len(freqs), dtype=bool)]
+        band_masks = []
+        for fmin, fmax in self.bands:
+            band_mask = (freqs >= fmin) & (freqs <= fmax)
+            if not np.any(band_mask):
+                raise ValueError('There are no frequency points between '
+                                 '{}Hz and {}Hz.'.format(fmin, fmax))
+            band_masks.append(band_mask)
+        return band_masks
+
+    def _set_con(self, con, freqs, n_epochs, n_tapers, n_channels,
+                 times=None):
+        # con is ([n_windows], n_bands, n_seeds, n_targets)
+        seeds, targets = self._get_seeds_targets(n_channels)
+        con = np.moveaxis(con, -3, -1)
+        if times is not None:
+            con = np.moveaxis(con, 0, -1)
+        if self.bands is None:
+            con = con[..., 0] if times is None else con[..., 0, :]
+        if self.packed:
+            con = con[np.triu_indices(len(seeds), 1)]
+        else:
+            con[np.equal.outer(seeds, targets)] = 0.
+        self.data_ = np.ascontiguousarray(con)
+        self.freqs_ = freqs[np.any(self._get_band_masks(freqs), axis=0)]
+        self.times_ = times
+        self.n_epochs_ = n_epochs
+        self.n_tappers_ = n_tapers
+
+    def _set_epoch_con(self, con, freqs, n_tapers, n_channels, times=None):
+        # con is (n_epochs, [n_windows], n_bands, n_seeds, n_targets)
+        seeds, targets = self._get_seeds_targets(n_channels)
+        con = np.moveaxis(con, -3, -1)
+        if times is not None:
+            con = np.moveaxis(con, 1, -1)
+        if self.bands is None:
+            con = con[..., 0] if times is None else con[..., 0, :]
+        if self.packed:
+            con = con[(slice(None),) + np.triu_indices(len(seeds), 1)]
+        else:
+            con[:, np.equal.outer(seeds, targets)] = 0.
+        self.data_ = np.ascontiguousarray(con)
+        self.freqs_ = freqs[np.any(self._get_band_masks(freqs), axis=0)]
+        self.times_ = times
+        self.n_epochs_ = len(con)
+        self.n_tappers_ = n_tapers
+
+    def _accumulate(self, acc, csd):
+        raise NotImplementedError
+
+    def _compute_con(self, acc, n_epochs):
+        raise NotImplementedError
+
+    def _compute_epoch_con(self, csd):
+        raise NotImplementedError
+
+    def _get_save_group(self):
+        if hasattr(self, '_partial_state'):
+            raise ValueError('Call finalize before saving.')
+        save_vars = self._get_save_vars(exclude=['ch_info_', 'estimator'])
+        if self.estimator is not None:
+            # The estimator is written by the HDF5Writer
+            save_vars['estimator_name_'] = self.estimator._get_title()
+        return self._get_title(), save_vars
+
+
+def _pack_triu(data):
+    """Keep the upper triangle of the first two axes of data"""
+    return data[np.triu_indices(data.shape[0], 1)]
+
+
+def _unpack_triu(packed, n_channels, rows=None, cols=None,
+                 antisymmetric=False):
+    """Expand packed upper triangle data into a (rows, cols) block
+
+    Only the requested block is built. The diagonal is zero. If
+    ``antisymmetric``, the lower triangle is the negated upper triangle.
+    """
+    rows = np.arange(n_channels)[slice(None) if rows is None else rows]
+    cols = np.arange(n_channels)[slice(None) if cols is None else cols]
+    idx_x = np.minimum.outer(rows, cols)
+    idx_y = np.maximum.outer(rows, cols)
+    # Position of (idx_x, idx_y) in np.triu_indices(n_channels, 1)
+    idx = (idx_x * (2 * n_channels - idx_x - 1)) // 2 + idx_y - idx_x - 1
+    diag = idx_x == idx_y
+    idx[diag] = 0
+    out = packed[idx]
+    out[diag] = 0.
+    if antisymmetric:
+        out[np.greater.outer(rows, cols)] *= -1
+    return out
+
+
+def _read_connectivity(cls, fname, comment='default', lazy=False,
+                       markers=None):
+    out = _read_container(cls, fname, comment=comment, lazy=lazy)
+    if hasattr(out, 'estimator_name_'):
+        if markers is None:
+            markers = {}
+        # Shared with the other markers read with the same markers
+        out.estimator = _read_marker(fname, out.estimator_name_, markers,
+                                     lazy=lazy)
+        del out.estimator_name_
+    return out
@@ -0,0 +1,295 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import fftconvolve, get_window
+
+from mne.utils import logger, _time_mask
+from mne.time_frequency import morlet
+from mne.time_frequency.multitaper import (_compute_mt_params,
+                                           _psd_from_mt_adaptive)
+
+# Upper bound for the cross-spectral densities computed at once
+_CSD_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def _check_time_window(tmin, tmax):
+    if tmin is not None and tmax is not None and tmin >= tmax:
+        raise ValueError('tmin ({}) must be smaller than tmax ({}).'.format(
+            tmin, tmax))
+
+
+def _get_epochs_data(epochs, tmin=None, tmax=None):
+    """Data and times of the epochs between tmin and tmax
+
+    The time window is applied as a slice, so if the epochs are preloaded
+    the result is a view and no data is copied.
+    """
+    times = epochs.times
+    sfreq = epochs.info['sfreq']
+    half_sample = 0.5 / sfreq
+    if ((tmin is not None and tmin < times[0] - half_sample) or
+            (tmax is not None and tmax > times[-1] + half_sample)):
+        raise ValueError('The time window ({}, {}) is outside of the epochs '
+                         '({}, {}).'.format(tmin, tmax, times[0], times[-1]))
+    idx = np.where(_time_mask(times, tmin, tmax, sfreq=sfreq))[0]
+    if len(idx) == 0:
+        raise ValueError('There are no samples between {}s and {}s.'.format(
+            tmin, tmax))
+    data = epochs._data if epochs.preload else epochs.get_data()
+    time_slice = slice(idx[0], idx[-1] + 1)
+    return data[..., time_slice], times[time_slice]
+
+
+def _compute_spectra(data, sfreq, fmin=None, fmax=np.inf, method_params=None):
+    """Compute weighted and normalized tapered spectra
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_epochs, ..., n_channels, n_times)
+        The data to transform. Extra axes (e.g. time windows) are kept.
+    sfreq : float
+        The sampling frequency.
+    fmin : float | None
+        The lower frequency of interest. If None, the lowest frequency with
+        at least 5 cycles in the data (same default as mne.connectivity).
+    fmax : float
+        The upper frequency of interest.
+    method_params : dict | None
+        The spectral estimation parameters. ``mode`` selects the method:
+
+        ``'multitaper'`` (default)
+            DPSS tapers. Uses ``mt_bandwidth``, ``mt_adaptive`` and
+            ``mt_low_bias``, as in mne.connectivity.
+        ``'fourier'``
+            A single ``window`` over the epoch. Defaults to the symmetric
+            Hanning window used by mne.connectivity.
+        ``'welch'``
+            Average over segments of ``n_per_seg`` samples (default 256)
+            overlapping by ``n_overlap`` samples (default half a segment),
+            each one multiplied by ``window`` (default ``'hamming'``).
+        ``'cwt_morlet'``
+            Morlet wavelets at ``cwt_freqs`` with ``cwt_n_cycles`` cycles
+            (default 7). The cross-spectra are averaged over time.
+
+    Returns
+    -------
+    spectra : ndarray, shape (n_epochs, ..., n_channels, n_tapers, n_freqs)
+        The spectra, scaled so that the cross-spectral density between two
+        signals is the sum over tapers of x * conj(y). Welch segments and
+        wavelet time samples are stored as tapers.
+    freqs : ndarray, shape (n_freqs,)
+        The frequencies.
+    n_tapers : int
+        The number of tapers used.
+    """
+    if method_params is None:
+        method_params = {}
+    mode = method_params.get('mode', 'multitaper')
+    n_epochs, n_times = data.shape[0], data.shape[-1]
+    if fmin is None:
+        fmin = 5. * sfreq / float(n_times)
+
+    adaptive = False
+    if mode == 'cwt_morlet':
+        freqs = method_params.get('cwt_freqs', None)
+        if freqs is None:
+            raise ValueError('cwt_freqs must be specified in method_params '
+                             'for the cwt_morlet mode.')
+        freqs = np.asarray(freqs, dtype=np.float64)
+        freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    else:
+        if mode == 'multitaper':
+            windows, eigvals, adaptive = _compute_mt_params(
+                n_times, sfreq, method_params.get('mt_bandwidth', None),
+                method_params.get('mt_low_bias', True),
+                method_params.get('mt_adaptive', False))
+            segments = data[..., np.newaxis, :]
+        elif mode == 'fourier':
+            window = method_params.get('window', None)
+            if window is None:
+                windows = np.hanning(n_times)
+            else:
+                windows = get_window(window, n_times)
+            segments = data[..., np.newaxis, :]
+        elif mode == 'welch':
+            n_per_seg = method_params.get('n_per_seg', min(256, n_times))
+            n_overlap = method_params.get('n_overlap', n_per_seg // 2)
+            if not 0 <= n_overlap < n_per_seg <= n_times:
+                raise ValueError('Need 0 <= n_overlap < n_per_seg <= '
+                                 'n_times. Got {}, {} and {}.'.format(
+                                     n_overlap, n_per_seg, n_times))
+            windows = get_window(method_params.get('window', 'hamming'),
+                                 n_per_seg)
+            segments = _sliding_windows(data, n_per_seg,
+                                        n_per_seg - n_overlap)
+        else:
+            raise ValueError('Unknown spectral mode: {}'.format(mode))
+        freqs = np.fft.rfftfreq(segments.shape[-1], 1. / sfreq)
+        freq_mask = (freqs >= fmin) & (freqs <= fmax)
+
+    if not np.any(freq_mask):
+        raise ValueError('There are no frequency points between '
+                         '{}Hz and {}Hz.'.format(fmin, fmax))
+
+    if mode == 'cwt_morlet':
+        spectra = _morlet_spectra(
+            data, sfreq, freqs[freq_mask],
+            method_params.get('cwt_n_cycles', 7.))
+    elif adaptive:
+        # The adaptive weights depend on the variance of the signals, which
+        # is estimated on the whole spectrum: mask only after computing them.
+        spectra = np.empty(segments.shape[:-2] + (len(windows),
+                                                  freq_mask.sum()),
+                           dtype=np.complex128)
+        weights = np.empty(spectra.shape)
+        all_freqs = np.ones(len(freqs), dtype=bool)
+        for i_epoch in range(n_epochs):
+            this_spectra = _windowed_spectra(
+                segments[i_epoch:i_epoch + 1], windows, all_freqs)[0]
+            this_spectra = this_spectra.reshape(
+                (-1,) + this_spectra.shape[-2:])
+            spectra[i_epoch] = this_spectra[..., freq_mask].reshape(
+                spectra.shape[1:])
+            # One-sided DC and Nyquist scaling, as in mne's _mt_spectra
+            this_spectra[..., 0] /= np.sqrt(2.)
+            if n_times % 2 == 0:
+                this_spectra[..., -1] /= np.sqrt(2.)
+            _, this_weights = _psd_from_mt_adaptive(
+                this_spectra, eigvals, freq_mask, return_weights=True)
+            weights[i_epoch] = this_weights.reshape(spectra.shape[1:])
+    else:
+        spectra = _windowed_spectra(segments, windows, freq_mask)
+    n_tapers = spectra.shape[-2]
+    logger.info('Computed {} spectra ({} tapers) for {} epochs'.format(
+        mode, n_tapers, n_epochs))
+
+    if mode == 'multitaper' and not adaptive:
+        weights = np.sqrt(eigvals)[:, np.newaxis]
+    elif not adaptive:
+        weights = np.ones((n_tapers, 1))
+
+    # Fold weights and normalization into the spectra
+    norm = np.sqrt((weights * weights).sum(axis=-2, keepdims=True) / 2.)
+    spectra *= weights / norm
+    return spectra, freqs[freq_mask], n_tapers
+
+
+def _windowed_spectra(segments, windows, freq_mask):
+    """Batched rFFT of windowed segments
+
+    segments has shape (n_epochs, ..., n_segments, n_samples) and windows
+    (n_windows, n_samples). Either n_segments or n_windows is 1.
+    """
+    n_epochs, n_samples = segments.shape[0], segments.shape[-1]
+    n_tapers = max(segments.shape[-2], np.atleast_2d(windows).shape[0])
+    spectra = np.empty(segments.shape[:-2] + (n_tapers, freq_mask.sum()),
+                       dtype=np.complex128)
+    # A chunk of epochs at a time, to bound the tapered copy of the data
+    n_signals = int(np.prod(segments.shape[1:-2]))
+    step = _get_chunk_size(n_signals * n_tapers * n_samples * 16, n_epochs)
+    for start in range(0, n_epochs, step):
+        this_data = segments[start:start + step]
+        this_data = this_data - this_data.mean(axis=-1, keepdims=True)
+        spectra[start:start + step] = np.fft.rfft(
+            this_data * windows, axis=-1)[..., freq_mask]
+    return spectra
+
+
+def _morlet_spectra(data, sfreq, freqs, n_cycles):
+    """Morlet wavelet coefficients, time samples as tapers"""
+    n_times = data.shape[-1]
+    wavelets = morlet(sfreq, freqs, n_cycles=n_cycles)
+    spectra = np.empty(data.shape + (len(freqs),), dtype=np.complex128)
+    data = data - data.mean(axis=-1, keepdims=True)
+    for i_freq, wavelet in enumerate(wavelets):
+        if len(wavelet) > n_times:
+            raise ValueError('At least one of the wavelets is longer than '
+                             'the signal. Use a longer signal or shorter '
+                             'wavelets.')
+        spectra[..., i_freq] = fftconvolve(
+            data, wavelet.reshape((1,) * (data.ndim - 1) + (-1,)),
+            mode='same', axes=-1)
+    return spectra
+
+
+def _sliding_windows(data, n_per_window, step):
+    """Zero-copy view of data split in (overlapping) windows
+
+    Returns a read-only view with shape (..., n_windows, n_per_window).
+    """
+    n_windows = (data.shape[-1] - n_per_window) // step + 1
+    shape = data.shape[:-1] + (n_windows, n_per_window)
+    strides = data.strides[:-1] + (data.strides[-1] * step,
+                                   data.strides[-1])
+    return as_strided(data, shape=shape, strides=strides, writeable=False)
+
+
+def _compute_csd(spectra_x, spectra_y):
+    """Cross-spectral densities between all pairs of signals
+
+    Parameters
+    ----------
+    spectra_x : ndarray, shape (..., n_x, n_tapers, n_freqs)
+        The spectra of the first set of signals.
+    spectra_y : ndarray, shape (..., n_y, n_tapers, n_freqs)
+        The spectra of the second set of signals.
+
+    Returns
+    -------
+    csd : ndarray, shape (..., n_freqs, n_x, n_y)
+        The cross-spectral densities.
+    """
+    # Frequencies first, so the sum over tapers is a batched BLAS product
+    spectra_x = np.moveaxis(spectra_x, -1, -3)
+    spectra_y = np.moveaxis(spectra_y, -1, -3)
+    return np.matmul(spectra_x, spectra_y.conj().swapaxes(-1, -2))
+
+
+def _get_chunk_size(bytes_per_item, n_items, max_bytes=_CSD_CHUNK_BYTES):
+    return int(max(min(max_bytes // max(bytes_per_item, 1), n_items), 1))
+
+
+def _get_pair_blocks(n_seeds, n_targets, bytes_per_pair,
+                     max_bytes=_CSD_CHUNK_BYTES, triu=False):
+    """Tile the (n_seeds, n_targets) channel pairs into blocks
+
+    One epoch of each block takes at most max_bytes (at least one pair per
+    block). Returns (seed_start, seed_stop, target_start, target_stop)
+    tuples. If triu, the blocks below the diagonal are skipped.
+    """
+    max_pairs = max(max_bytes // max(bytes_per_pair, 1), 1)
+    if n_seeds * n_targets <= max_pairs:
+        return [(0, n_seeds, 0, n_targets)]
+    seed_step = int(min(max(np.sqrt(max_pairs), 1), n_seeds))
+    target_step = int(min(max(max_pairs // seed_step, 1), n_targets))
+    blocks = []
+    for seed_start in range(0, n_seeds, seed_step):
+        seed_stop = min(seed_start + seed_step, n_seeds)
+        for target_start in range(0, n_targets, target_step):
+            target_stop = min(target_start + target_step, n_targets)
+            if triu and target_stop <= seed_start:
+                continue
+            blocks.append((seed_start, seed_stop, target_start, target_stop))
+    return blocks
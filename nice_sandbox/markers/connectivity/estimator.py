@@ -0,0 +1,79 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+
+import numpy as np
+
+from ...markers.base import BaseContainerSandbox, _read_container
+from ...markers.cache import _fit_cached
+from ...utils import plan_execution, limit_threads
+from .engine import (_compute_spectra, _get_epochs_data,
+                     _check_time_window)
+
+
+class CrossSpectralEstimator(BaseContainerSandbox):
+    """Tapered spectra shared by the connectivity markers
+
+    The spectra are computed once per epochs object and stored already
+    weighted and normalized, so that the cross-spectral density between two
+    channels is the sum over tapers of ``x * conj(y)``. This matches the
+    cross-spectral density computed by ``mne.connectivity``.
+    """
+
+    def __init__(self, tmin=None, tmax=None, fmin=None, fmax=None,
+                 method_params=None, comment='default'):
+        BaseContainerSandbox.__init__(self, comment=comment)
+        if method_params is None:
+            method_params = {}
+        if fmax is None:
+            fmax = np.inf
+        _check_time_window(tmin, tmax)
+        self.tmin = tmin
+        self.tmax = tmax
+        self.fmin = fmin
+        self.fmax = fmax
+        self.method_params = method_params
+
+    def fit(self, epochs):
+        return _fit_cached(self, epochs, self._fit_uncached)
+
+    def _fit_uncached(self, epochs):
+        self.ch_info_ = epochs.info
+        _, n_threads = plan_execution(1)
+        with limit_threads(n_threads):
+            self._fit(epochs)
+        return self
+
+    def _fit(self, epochs):
+        data, _ = _get_epochs_data(epochs, self.tmin, self.tmax)
+        self.data_, self.freqs_, self.n_tapers_ = _compute_spectra(
+            data, epochs.info['sfreq'], fmin=self.fmin, fmax=self.fmax,
+            method_params=self.method_params)
+        self.n_epochs_ = len(data)
+
+    @classmethod
+    def _read(cls, fname, comment='default', lazy=False):
+        return _read_container(cls, fname, comment=comment, lazy=lazy)
+
+
+def read_csd_estimator(fname, comment='default', lazy=False):
+    return CrossSpectralEstimator._read(fname, comment=comment, lazy=lazy)
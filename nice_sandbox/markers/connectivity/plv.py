@@ -22,69 +22,36 @@
 
 
 import numpy as np
-from collections import OrderedDict
 
-import mne
-from mne.utils import logger
+from .base import BaseConnectivity, _read_connectivity
 
-from ...markers.base import BaseMarkerSandbox, _read_container
 
+class PhaseLockingValue(BaseConnectivity):
 
-class PhaseLockingValue(BaseMarkerSandbox):
-    def __init__(self, tmin=None, tmax=None, fmin=None, fmax=None,
-                 method_params=None, n_jobs='auto', comment='default'):
-        BaseMarkerSandbox.__init__(
-            self, tmin=None, tmax=None, comment=comment)
-        if method_params is None:
-            method_params = {}
-        if fmax is None:
-            fmax = np.inf
-        self.fmin = fmin
-        self.fmax = fmax
-        self.method_params = method_params
-        if n_jobs == 'auto':
-            try:
-                import multiprocessing as mp
-                import mkl
-                n_jobs = int(mp.cpu_count() / mkl.get_max_threads())
-                logger.info(
-                    'Autodetected number of jobs {}'.format(n_jobs))
-            except Exception:
-                logger.info('Cannot autodetect number of jobs')
-                n_jobs = 1
-        self.n_jobs = n_jobs
+    _method = 'plv'
 
-    @property
-    def _axis_map(self):
-        return OrderedDict([
-            ('channels', 0),
-            ('channels_y', 1)
-        ])
+    def _accumulate(self, acc, csd):
+        if acc is None:
+            acc = np.zeros(csd.shape[1:], dtype=np.complex128)
+        acc += (csd / np.abs(csd)).sum(axis=0)
+        return acc
 
-    def _fit(self, epochs):
-        data, freqs, times, n_epochs, n_tappers = \
-            mne.connectivity.spectral_connectivity(
-                epochs, method='plv', indices=None,
-                sfreq=epochs.info['sfreq'], mode='multitaper', fmin=self.fmin,
-                fmax=self.fmax, tmin=self.tmin, tmax=self.tmax, faverage=True,
-                n_jobs=self.n_jobs)
-        self.data_ = np.squeeze(data)
-        self.data_ += self.data_.T
-        self.freqs_ = freqs[0]
-        self.times_ = times
-        self.n_epochs_ = n_epochs
-        self.n_tappers_ = n_tappers
+    def _compute_con(self, acc, n_epochs):
+        return np.abs(acc / n_epochs)
 
     @classmethod
-    def _read(cls, fname, comment='default'):
-        return _read_plv(cls, fname=fname, comment=comment)
+    def _read(cls, fname, comment='default', lazy=False, markers=None):
+        return _read_plv(cls, fname=fname, comment=comment, lazy=lazy,
+                         markers=markers)
 
 
-def _read_plv(cls, fname, comment='default'):
-    out = _read_container(cls, fname, comment=comment)
+def _read_plv(cls, fname, comment='default', lazy=False, markers=None):
+    out = _read_connectivity(cls, fname, comment=comment, lazy=lazy,
+                             markers=markers)
     return out
 
 
-def read_plv(fname, comment='default'):
-    out = PhaseLockingValue._read(fname, comment=comment)
+def read_plv(fname, comment='default', lazy=False, markers=None):
+    out = PhaseLockingValue._read(fname, comment=comment, lazy=lazy,
+                                  markers=markers)
     return out
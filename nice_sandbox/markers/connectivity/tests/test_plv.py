@@ -21,13 +21,16 @@
 # applications.
 
 import numpy as np
+from numpy.testing import assert_array_almost_equal
+from nose.tools import assert_raises, assert_equal, assert_true
 
 import mne
 
 from nice.utils import create_mock_data_egi
 from nice.markers.tests.test_markers import _base_io_test, _base_reduction_test
 
-from nice_sandbox.markers.connectivity import PhaseLockingValue, read_plv
+from nice_sandbox.markers.connectivity import (PhaseLockingValue, read_plv,
+                                               CrossSpectralEstimator)
 
 n_epochs = 30
 raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
@@ -59,6 +62,181 @@ def test_wpli():
     _base_reduction_test(plv, epochs)
 
 
+def test_plv_estimator():
+    """Test computation of PLV markers from a shared estimator"""
+    estimator = CrossSpectralEstimator(fmin=4., fmax=12.)
+    plv = PhaseLockingValue(fmin=4., fmax=12., estimator=estimator)
+
+    _base_io_test(plv, epochs, read_plv)
+    _base_reduction_test(plv, epochs)
+
+    # Same values as computing the spectra inside the marker
+    plv_ref = PhaseLockingValue(fmin=4., fmax=12.).fit(epochs)
+    assert_array_almost_equal(plv.data_, plv_ref.data_)
+
+    # The spectra of a narrower band are a view of the estimator ones
+    plv_alpha = PhaseLockingValue(fmin=8., fmax=12., estimator=estimator)
+    spectra = []
+    fit_spectra = plv_alpha._fit_spectra
+    plv_alpha._fit_spectra = lambda *args: (spectra.append(args[0]),
+                                            fit_spectra(*args))
+    plv_alpha.fit(epochs)
+    assert_true(spectra[0].shape[-1] < estimator.data_.shape[-1])
+    assert_true(np.shares_memory(spectra[0], estimator.data_))
+
+
+def test_plv_engine():
+    """Test that the native PLV engine matches mne.connectivity"""
+    for fmin, fmax in [(None, None), (4., 12.)]:
+        plv_mne = PhaseLockingValue(
+            fmin=fmin, fmax=fmax, method_params={'engine': 'mne'})
+        plv_mne.fit(epochs)
+        plv = PhaseLockingValue(fmin=fmin, fmax=fmax).fit(epochs)
+        assert_array_almost_equal(plv.data_, plv_mne.data_)
+        assert_array_almost_equal(plv.freqs_, plv_mne.freqs_)
+
+
+def test_plv_bands():
+    """Test computation of PLV markers in several bands at once"""
+    bands = [(4., 8.), (8., 12.), (12., 30.)]
+    plv = PhaseLockingValue(bands=bands)
+
+    _base_io_test(plv, epochs, read_plv)
+    _base_reduction_test(plv, epochs)
+    assert plv.data_.shape[-1] == len(bands)
+    assert plv._axis_map['frequency'] == 2
+
+    for i_band, (fmin, fmax) in enumerate(bands):
+        plv_band = PhaseLockingValue(fmin=fmin, fmax=fmax).fit(epochs)
+        assert_array_almost_equal(plv.data_[..., i_band],
+                                  plv_band.data_)
+
+
+def test_plv_partial_fit():
+    """Test computation of PLV markers over chunks of epochs"""
+    plv = PhaseLockingValue()
+    for start in range(0, len(epochs), 7):
+        plv.partial_fit(epochs[start:start + 7])
+    plv.finalize()
+
+    plv_ref = PhaseLockingValue().fit(epochs)
+    assert_array_almost_equal(plv.data_, plv_ref.data_)
+    assert plv.n_epochs_ == len(epochs)
+
+
+def test_plv_packed():
+    """Test PLV markers stored as a packed upper triangle"""
+    plv = PhaseLockingValue(bands=[(4., 8.), (8., 12.)], packed=True)
+
+    _base_io_test(plv, epochs, read_plv)
+    _base_reduction_test(plv, epochs)
+
+    n_channels = len(epochs.ch_names)
+    assert plv.data_.shape == (n_channels * (n_channels - 1) // 2, 2)
+
+    plv_ref = PhaseLockingValue(bands=[(4., 8.), (8., 12.)]).fit(epochs)
+    for picks in [None, {'channels': [0, 2], 'channels_y': [1, 3, 4]}]:
+        assert_array_almost_equal(
+            plv._prepare_data(picks, 'scalar'),
+            plv_ref._prepare_data(picks, 'scalar'))
+    red = [{'axis': 'frequency', 'function': np.mean},
+           {'axis': 'channels_y', 'function': np.mean},
+           {'axis': 'channels', 'function': np.mean}]
+    assert_array_almost_equal(plv.reduce_to_topo(red),
+                              plv_ref.reduce_to_topo(red))
+
+
+def test_plv_seeds():
+    """Test computation of PLV markers between seeds and targets"""
+    seeds, targets = [0, 3], [1, 2, 3, 4]
+    plv = PhaseLockingValue(seeds=seeds, targets=targets)
+
+    _base_io_test(plv, epochs, read_plv)
+    _base_reduction_test(plv, epochs)
+
+    plv_ref = PhaseLockingValue().fit(epochs)
+    assert_array_almost_equal(plv.data_,
+                              plv_ref.data_[np.ix_(seeds, targets)])
+
+
+def test_plv_modes():
+    """Test computation of PLV markers with other spectral modes"""
+    # Adaptive weights need at least 3 tapers
+    for method_params in [
+            {'mode': 'fourier'},
+            {'mode': 'multitaper', 'mt_bandwidth': 6., 'mt_adaptive': True}]:
+        plv = PhaseLockingValue(fmin=4., fmax=30., method_params=method_params)
+        plv.fit(epochs)
+        plv_mne = PhaseLockingValue(fmin=4., fmax=30., method_params=dict(
+            engine='mne', **method_params)).fit(epochs)
+        assert_array_almost_equal(plv.data_, plv_mne.data_)
+
+    for method_params in [
+            {'mode': 'multitaper', 'mt_bandwidth': 2., 'mt_adaptive': True},
+            {'mode': 'welch', 'n_per_seg': 128, 'n_overlap': 64},
+            {'mode': 'cwt_morlet', 'cwt_freqs': np.arange(6., 30., 2.),
+             'cwt_n_cycles': 3.}]:
+        plv = PhaseLockingValue(fmin=4., fmax=30., method_params=method_params)
+        _base_io_test(plv, epochs, read_plv)
+        assert np.all(np.isfinite(plv.data_))
+
+
+def test_plv_time_window():
+    """Test computation of PLV markers in a time window"""
+    plv = PhaseLockingValue(tmin=0., tmax=1.)
+    _base_io_test(plv, epochs, read_plv)
+
+    plv_mne = PhaseLockingValue(tmin=0., tmax=1.,
+                                method_params={'engine': 'mne'})
+    plv_mne.fit(epochs)
+    assert_array_almost_equal(plv.data_, plv_mne.data_)
+
+    assert_raises(ValueError, PhaseLockingValue, tmin=1., tmax=0.)
+    assert_raises(ValueError, PhaseLockingValue(tmin=-1.).fit, epochs)
+
+
+def test_plv_time_resolved():
+    """Test computation of PLV markers in sliding windows"""
+    plv = PhaseLockingValue(window_length=.5, window_step=.25,
+                            bands=((4., 8.), (8., 13.)))
+    _base_io_test(plv, epochs, read_plv)
+    _base_reduction_test(plv, epochs)
+    assert_equal(plv.data_.shape[-1], len(plv.times_))
+
+    # The first window is the same as a marker on that time window
+    n_window = int(round(.5 * epochs.info['sfreq']))
+    plv_window = PhaseLockingValue(
+        tmax=epochs.times[n_window - 1], bands=((4., 8.), (8., 13.)))
+    plv_window.fit(epochs)
+    assert_array_almost_equal(plv.data_[..., 0], plv_window.data_)
+
+    assert_raises(ValueError, PhaseLockingValue, window_step=.25)
+    assert_raises(ValueError, PhaseLockingValue, window_length=-1.)
+    plv = PhaseLockingValue(window_length=100.)
+    assert_raises(ValueError, plv.fit, epochs)
+
+
+def test_plv_per_epoch():
+    """Test that single-trial PLV markers are not available"""
+    # The PLV is only defined across epochs
+    assert_raises(ValueError, PhaseLockingValue, per_epoch=True)
+    assert_raises(ValueError, PhaseLockingValue, per_epoch=True,
+                  bands=((4., 8.), (8., 13.)), packed=True)
+
+
+def test_plv_max_memory():
+    """Test computation of PLV markers in blocks of channel pairs"""
+    plv = PhaseLockingValue(bands=((4., 8.), (8., 13.)))
+    plv.fit(epochs)
+    plv_blocks = PhaseLockingValue(bands=((4., 8.), (8., 13.)),
+                                   max_memory='16K')
+    plv_blocks.fit(epochs)
+    assert_array_almost_equal(plv.data_, plv_blocks.data_)
+
+    assert_raises(ValueError, PhaseLockingValue, max_memory='lots')
+    assert_raises(ValueError, PhaseLockingValue, max_memory=0)
+
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__name__)
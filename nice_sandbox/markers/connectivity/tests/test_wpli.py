@@ -20,14 +20,26 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 
+import os
+import tracemalloc
+
 import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nose.tools import assert_raises, assert_equal, assert_true
+
+import h5py
 
 import mne
+from mne.utils import _TempDir
 
 from nice.utils import create_mock_data_egi
 from nice.markers.tests.test_markers import _base_io_test, _base_reduction_test
 
-from nice_sandbox.markers.connectivity import WeightedPhaseLagIndex, read_wpli
+from nice_sandbox.utils import plan_execution
+from nice_sandbox.markers.connectivity import (WeightedPhaseLagIndex,
+                                               read_wpli,
+                                               CrossSpectralEstimator)
+from nice_sandbox.markers.base import _is_fitted
 
 n_epochs = 30
 raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
@@ -59,6 +71,287 @@ def test_wpli():
     _base_reduction_test(wpli, epochs)
 
 
+def test_wpli_estimator():
+    """Test computation of wPLI markers from a shared estimator"""
+    estimator = CrossSpectralEstimator(fmin=4., fmax=12.)
+    wpli = WeightedPhaseLagIndex(fmin=4., fmax=12., estimator=estimator)
+
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+
+    # Same values as computing the spectra inside the marker
+    wpli_ref = WeightedPhaseLagIndex(fmin=4., fmax=12.).fit(epochs)
+    assert_array_almost_equal(wpli.data_, wpli_ref.data_)
+
+
+def test_wpli_engine():
+    """Test that the native wPLI engine matches mne.connectivity"""
+    for fmin, fmax in [(None, None), (4., 12.)]:
+        wpli_mne = WeightedPhaseLagIndex(
+            fmin=fmin, fmax=fmax, method_params={'engine': 'mne'})
+        wpli_mne.fit(epochs)
+        wpli = WeightedPhaseLagIndex(fmin=fmin, fmax=fmax).fit(epochs)
+        assert_array_almost_equal(wpli.data_, wpli_mne.data_)
+        assert_array_almost_equal(wpli.freqs_, wpli_mne.freqs_)
+
+
+def test_wpli_engine_threads():
+    """Test the thread pools of the processes of the mne engine"""
+    calls = []
+    spectral_connectivity = mne.connectivity.spectral_connectivity
+
+    def _spectral_connectivity(*args, **kwargs):
+        calls.append((kwargs['n_jobs'], os.environ.get('OMP_NUM_THREADS'),
+                      os.environ.get('OPENBLAS_NUM_THREADS')))
+        return spectral_connectivity(*args, **kwargs)
+
+    mne.connectivity.spectral_connectivity = _spectral_connectivity
+    try:
+        wpli = WeightedPhaseLagIndex(method_params={'engine': 'mne'},
+                                     n_jobs=2)
+        wpli.fit(epochs)
+    finally:
+        mne.connectivity.spectral_connectivity = spectral_connectivity
+    # The workers share the CPUs
+    n_procs, n_threads = plan_execution(2)
+    assert_equal(calls, [(n_procs, str(n_threads), str(n_threads))])
+
+
+def test_wpli_bands():
+    """Test computation of wPLI markers in several bands at once"""
+    bands = [(4., 8.), (8., 12.), (12., 30.)]
+    wpli = WeightedPhaseLagIndex(bands=bands)
+
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+    assert wpli.data_.shape[-1] == len(bands)
+    assert wpli._axis_map['frequency'] == 2
+
+    for i_band, (fmin, fmax) in enumerate(bands):
+        wpli_band = WeightedPhaseLagIndex(fmin=fmin, fmax=fmax).fit(epochs)
+        assert_array_almost_equal(wpli.data_[..., i_band],
+                                  wpli_band.data_)
+
+
+def test_wpli_partial_fit():
+    """Test computation of wPLI markers over chunks of epochs"""
+    wpli = WeightedPhaseLagIndex()
+    for start in range(0, len(epochs), 7):
+        wpli.partial_fit(epochs[start:start + 7])
+    wpli.finalize()
+
+    wpli_ref = WeightedPhaseLagIndex().fit(epochs)
+    assert_array_almost_equal(wpli.data_, wpli_ref.data_)
+    assert wpli.n_epochs_ == len(epochs)
+
+
+def test_wpli_packed():
+    """Test wPLI markers stored as a packed upper triangle"""
+    wpli = WeightedPhaseLagIndex(bands=[(4., 8.), (8., 12.)], packed=True)
+
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+
+    n_channels = len(epochs.ch_names)
+    assert wpli.data_.shape == (n_channels * (n_channels - 1) // 2, 2)
+
+    wpli_ref = WeightedPhaseLagIndex(bands=[(4., 8.), (8., 12.)]).fit(epochs)
+    for picks in [None, {'channels': [0, 2], 'channels_y': [1, 3, 4]}]:
+        assert_array_almost_equal(
+            wpli._prepare_data(picks, 'scalar'),
+            wpli_ref._prepare_data(picks, 'scalar'))
+    red = [{'axis': 'frequency', 'function': np.mean},
+           {'axis': 'channels_y', 'function': np.mean},
+           {'axis': 'channels', 'function': np.mean}]
+    assert_array_almost_equal(wpli.reduce_to_topo(red),
+                              wpli_ref.reduce_to_topo(red))
+
+
+def test_wpli_seeds():
+    """Test computation of wPLI markers between seeds and targets"""
+    seeds, targets = [0, 3], [1, 2, 3, 4]
+    wpli = WeightedPhaseLagIndex(seeds=seeds, targets=targets)
+
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+
+    wpli_ref = WeightedPhaseLagIndex().fit(epochs)
+    assert_array_almost_equal(wpli.data_,
+                              wpli_ref.data_[np.ix_(seeds, targets)])
+
+
+def test_wpli_modes():
+    """Test computation of wPLI markers with other spectral modes"""
+    # Adaptive weights need at least 3 tapers
+    for method_params in [
+            {'mode': 'fourier'},
+            {'mode': 'multitaper', 'mt_bandwidth': 6., 'mt_adaptive': True}]:
+        wpli = WeightedPhaseLagIndex(fmin=4., fmax=30.,
+                                     method_params=method_params)
+        wpli.fit(epochs)
+        wpli_mne = WeightedPhaseLagIndex(
+            fmin=4., fmax=30., method_params=dict(engine='mne',
+                                                  **method_params)).fit(epochs)
+        assert_array_almost_equal(wpli.data_, wpli_mne.data_)
+
+    for method_params in [
+            {'mode': 'multitaper', 'mt_bandwidth': 2., 'mt_adaptive': True},
+            {'mode': 'welch', 'n_per_seg': 128, 'n_overlap': 64},
+            {'mode': 'cwt_morlet', 'cwt_freqs': np.arange(6., 30., 2.),
+             'cwt_n_cycles': 3.}]:
+        wpli = WeightedPhaseLagIndex(fmin=4., fmax=30.,
+                                     method_params=method_params)
+        _base_io_test(wpli, epochs, read_wpli)
+        assert np.all(np.isfinite(wpli.data_))
+
+
+def test_wpli_time_window():
+    """Test computation of wPLI markers in a time window"""
+    wpli = WeightedPhaseLagIndex(tmin=0., tmax=1.)
+    _base_io_test(wpli, epochs, read_wpli)
+
+    wpli_mne = WeightedPhaseLagIndex(tmin=0., tmax=1.,
+                                     method_params={'engine': 'mne'})
+    wpli_mne.fit(epochs)
+    assert_array_almost_equal(wpli.data_, wpli_mne.data_)
+
+    assert_raises(ValueError, WeightedPhaseLagIndex, tmin=1., tmax=0.)
+    assert_raises(ValueError, WeightedPhaseLagIndex(tmin=-1.).fit, epochs)
+
+
+def test_wpli_time_resolved():
+    """Test computation of wPLI markers in sliding windows"""
+    wpli = WeightedPhaseLagIndex(window_length=.5, window_step=.25,
+                                 bands=((4., 8.), (8., 13.)))
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+    assert_equal(wpli.data_.shape[-1], len(wpli.times_))
+
+    # The first window is the same as a marker on that time window
+    n_window = int(round(.5 * epochs.info['sfreq']))
+    wpli_window = WeightedPhaseLagIndex(
+        tmax=epochs.times[n_window - 1], bands=((4., 8.), (8., 13.)))
+    wpli_window.fit(epochs)
+    assert_array_almost_equal(wpli.data_[..., 0], wpli_window.data_)
+
+    assert_raises(ValueError, WeightedPhaseLagIndex, window_step=.25)
+    assert_raises(ValueError, WeightedPhaseLagIndex, window_length=-1.)
+    wpli = WeightedPhaseLagIndex(window_length=100.)
+    assert_raises(ValueError, wpli.fit, epochs)
+
+
+def test_wpli_per_epoch():
+    """Test computation of single-trial wPLI markers"""
+    wpli = WeightedPhaseLagIndex(per_epoch=True, bands=((4., 8.), (8., 13.)))
+    _base_io_test(wpli, epochs, read_wpli)
+    _base_reduction_test(wpli, epochs)
+    assert_equal(wpli.data_.dtype, np.float32)
+    assert_equal(wpli.data_.shape[0], len(epochs))
+
+    wpli_packed = WeightedPhaseLagIndex(per_epoch=True, packed=True,
+                                        bands=((4., 8.), (8., 13.)))
+    wpli_packed.fit(epochs)
+    assert_array_almost_equal(
+        wpli_packed._prepare_data({}, []), wpli.data_)
+
+    wpli = WeightedPhaseLagIndex(per_epoch=True,
+                                 method_params={'engine': 'mne'})
+    assert_raises(ValueError, wpli.fit, epochs)
+
+
+def test_wpli_max_memory():
+    """Test computation of wPLI markers in blocks of channel pairs"""
+    wpli = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)))
+    wpli.fit(epochs)
+    wpli_blocks = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)),
+                                        max_memory='16K')
+    wpli_blocks.fit(epochs)
+    assert_array_almost_equal(wpli.data_, wpli_blocks.data_)
+
+    assert_raises(ValueError, WeightedPhaseLagIndex, max_memory='lots')
+    assert_raises(ValueError, WeightedPhaseLagIndex, max_memory=0)
+
+    # The peak memory of the fit scales with max_memory
+    rng = np.random.RandomState(0)
+    spectra = (rng.randn(20, 32, 3, 50) +
+               1j * rng.randn(20, 32, 3, 50))
+    freqs = np.linspace(4., 13., 50)
+    peaks, data = {}, {}
+    for max_memory in [None, '1M', '64K']:
+        wpli = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)),
+                                     max_memory=max_memory)
+        tracemalloc.start()
+        wpli._fit_spectra(spectra, freqs, 3)
+        peaks[max_memory] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        data[max_memory] = wpli.data_
+    assert_array_almost_equal(data['1M'], data[None])
+    assert_array_almost_equal(data['64K'], data[None])
+    assert_true(peaks['64K'] < peaks['1M'] < peaks[None])
+    assert_true(peaks['1M'] < 4 * 1024 ** 2)
+    assert_true(peaks['64K'] < 8 * 64 * 1024)
+
+
+def test_wpli_lazy():
+    """Test reading wPLI markers lazily"""
+    estimator = CrossSpectralEstimator()
+    wpli = WeightedPhaseLagIndex(per_epoch=True, estimator=estimator)
+    wpli.fit(epochs)
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-lazy.hdf5'
+    wpli.save(tmp_fname)
+
+    wpli_lazy = read_wpli(tmp_fname, lazy=True)
+    assert_true(_is_fitted(wpli_lazy))
+    red = [{'axis': 'channels_y', 'function': np.sum},
+           {'axis': 'epochs', 'function': np.median},
+           {'axis': 'channels', 'function': np.mean}]
+    picks = {'channels': [0, 2, 3], 'epochs': np.arange(5, 20)}
+    for target in ['topography', 'scalar', 'epochs']:
+        assert_array_almost_equal(
+            wpli_lazy._reduce_to(red, target, picks),
+            wpli._reduce_to(red, target, picks))
+    # Reductions read the data from the file
+    assert_true('data_' not in vars(wpli_lazy))
+
+    assert_true(isinstance(wpli_lazy.data_, np.memmap))
+    assert_array_almost_equal(wpli_lazy.data_, wpli.data_)
+    assert_array_almost_equal(wpli_lazy.estimator.data_, estimator.data_)
+
+
+def test_wpli_storage():
+    """Test saving wPLI markers compressed and chunked"""
+    estimator = CrossSpectralEstimator()
+    wpli = WeightedPhaseLagIndex(per_epoch=True, dtype='float64',
+                                 estimator=estimator)
+    wpli.fit(epochs)
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-storage.hdf5'
+    storage = dict(compression='gzip', compression_opts=4, shuffle=True,
+                   chunks={'channels': 1, 'frequency': 4}, dtype='float32')
+    wpli.save(tmp_fname, storage=storage)
+    with h5py.File(tmp_fname, 'r') as h5fid:
+        data = h5fid[wpli._get_title() + '/key_data_']
+        assert_equal(data.chunks, (len(epochs), 1) + wpli.data_.shape[2:])
+        assert_equal(data.compression, 'gzip')
+        assert_equal(data.dtype, np.float32)
+        assert_equal(h5fid[estimator._get_title() + '/key_data_'].dtype,
+                     np.complex64)
+
+    wpli_read = read_wpli(tmp_fname)
+    assert_array_almost_equal(wpli_read.data_, wpli.data_, decimal=5)
+    assert_array_equal(wpli_read.freqs_, wpli.freqs_)
+    wpli_lazy = read_wpli(tmp_fname, lazy=True)
+    assert_array_almost_equal(
+        wpli_lazy.reduce_to_topo(None, picks={'channels_y': [0, 1]}),
+        wpli.reduce_to_topo(None, picks={'channels_y': [0, 1]}), decimal=5)
+
+    assert_raises(ValueError, wpli.save, tmp_fname, overwrite=True,
+                  storage=dict(compression='zip'))
+    assert_raises(ValueError, wpli.save, tmp_fname, overwrite=True,
+                  storage=dict(level=9))
+
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__name__)
@@ -0,0 +1,407 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+from collections import OrderedDict
+from pathlib import Path
+import tempfile
+from weakref import WeakValueDictionary
+
+import numpy as np
+
+import h5py
+from mne.utils import logger
+from mne.externals.h5io._h5io import _triage_write, _triage_read
+from mne.io.meas_info import Info
+
+from ..collection import _get_dependencies
+
+_CH_INFO_TITLE = 'nice/data/ch_info'
+
+# Channel info of the files read, while markers use it
+_ch_info_cache = WeakValueDictionary()
+
+_STORAGE_DEFAULTS = dict(compression=None, compression_opts=None,
+                         shuffle=False, chunks=None, dtype=None)
+
+# Smaller types for float32 storage
+_DOWNCAST = {np.dtype('float64'): np.float32,
+             np.dtype('complex128'): np.complex64}
+
+
+class HDF5Writer(object):
+    """Write many markers to one HDF5 file through a single handle
+
+    Markers are queued with ``add`` and written when the writer is
+    flushed (on exit when used as a context manager). The channel info is
+    written once, and the markers, estimators and parents shared by several
+    markers are written once, identified by their title. Dependencies that
+    are already in the file are kept as they are; the markers added
+    explicitly replace their previous version.
+
+    Markers that do not describe their HDF5 group (``_get_save_group``),
+    like the ones from nice, are saved with their own ``save`` after the
+    file is closed. With storage options, they are saved to a temporary file
+    first, and copied with their arrays (and the ones of their estimator)
+    written with the storage options.
+
+    Parameters
+    ----------
+    fname : str | Path
+        The file to write.
+    overwrite : bool | 'update'
+        If True, the file is replaced. If 'update', the markers are added to
+        the file. If False, the file must not exist.
+    storage : dict | None
+        How to store the arrays of the fitted attributes (e.g. ``data_``).
+        By default they are stored uncompressed and contiguous, so that they
+        can be memory mapped when read lazily. The options are:
+
+        ``compression`` : None | 'gzip' | 'lzf'
+            The compression filter.
+        ``compression_opts`` : int | None
+            The gzip level (0-9).
+        ``shuffle`` : bool
+            Whether to shuffle the bytes before compressing, which usually
+            compresses floats better.
+        ``chunks`` : dict | None
+            The chunk length along each axis of ``data_``, by axis name
+            (e.g. ``{'channels': 1}`` to read one channel from one chunk).
+            The axes not given are not split. If None, or for arrays
+            without axes, the chunks are chosen by h5py when needed.
+        ``dtype`` : None | 'float32'
+            If 'float32', ``data_`` is stored in single precision if it is
+            in double precision. The other arrays (e.g. ``freqs_``) are
+            kept as they are.
+    """
+
+    def __init__(self, fname, overwrite=False, storage=None):
+        if not isinstance(fname, Path):
+            fname = Path(fname)
+        if overwrite not in (True, False, 'update'):
+            raise ValueError('overwrite must be True, False or "update"')
+        self.fname = fname
+        self.overwrite = overwrite
+        self.storage = _check_storage(storage)
+        self._queue = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, marker):
+        """Queue a marker, and the markers it depends on, for writing"""
+        self._add(marker, replace=True)
+        return self
+
+    def _add(self, marker, replace):
+        title = marker._get_title()
+        if title in self._queue:
+            # Shared dependency, or added again explicitly
+            self._queue[title][1] |= replace
+            return
+        self._queue[title] = [marker, replace]
+        if hasattr(marker, '_get_save_group'):
+            # nice markers save their own dependencies
+            for dep in _get_dependencies(marker):
+                self._add(dep, replace=False)
+
+    def flush(self):
+        """Write all the queued markers in one pass"""
+        if len(self._queue) == 0:
+            return
+        mode = 'w'
+        if self.fname.exists():
+            if self.overwrite is False:
+                raise IOError('file "{}" exists, use overwrite=True to '
+                              'overwrite'.format(self.fname))
+            elif self.overwrite == 'update':
+                mode = 'a'
+        comp_kw = dict(compression='gzip', compression_opts=4)
+        deferred = []
+        with h5py.File(str(self.fname), mode) as h5fid:
+            for title, (marker, replace) in self._queue.items():
+                if title in h5fid and not replace:
+                    logger.info('{} already present in HDF5 file, will not '
+                                'be overwritten'.format(title))
+                    continue
+                if not hasattr(marker, '_get_save_group'):
+                    deferred.append(marker)
+                    continue
+                if (_CH_INFO_TITLE not in h5fid and
+                        hasattr(marker, 'ch_info_')):
+                    logger.info('Writing channel info to HDF5 file')
+                    _write_group(h5fid, _CH_INFO_TITLE, marker.ch_info_,
+                                 comp_kw, slash='error')
+                logger.info('Writing {} to HDF5 file'.format(title))
+                title, save_vars = marker._get_save_group()
+                _write_marker_group(h5fid, title, save_vars, comp_kw,
+                                    self.storage, marker)
+        for marker in deferred:
+            logger.info('Writing {} to HDF5 file'.format(marker._get_title()))
+            if self.storage == _STORAGE_DEFAULTS:
+                marker.save(self.fname, overwrite='update')
+            else:
+                _save_with_storage(marker, self.fname, self.storage)
+        self._queue.clear()
+
+
+def _write_group(h5fid, title, data, comp_kw, slash='replace'):
+    # What write_hdf5 does, on an open file
+    if title in h5fid:
+        del h5fid[title]
+    _triage_write(title, data, h5fid, comp_kw, str(type(data)), [],
+                  slash=slash, title=title)
+
+
+def _check_storage(storage):
+    out = dict(_STORAGE_DEFAULTS)
+    if storage is None:
+        return out
+    unknown = sorted(set(storage) - set(out))
+    if len(unknown) > 0:
+        raise ValueError('Unknown storage options: {}'.format(unknown))
+    out.update(storage)
+    if out['compression'] not in (None, 'gzip', 'lzf'):
+        raise ValueError('compression must be None, "gzip" or "lzf"')
+    if out['dtype'] not in (None, 'float32'):
+        raise ValueError('dtype must be None or "float32"')
+    if out['chunks'] is not None and not isinstance(out['chunks'], dict):
+        raise ValueError('chunks must be a dict of chunk lengths by axis '
+                         'name')
+    return out
+
+
+def _write_marker_group(h5fid, title, save_vars, comp_kw, storage, marker):
+    if storage == _STORAGE_DEFAULTS:
+        _write_group(h5fid, title, save_vars, comp_kw)
+        return
+    # The arrays are written with the storage options, as h5io would
+    arrays = {k: v for k, v in save_vars.items()
+              if k.endswith('_') and isinstance(v, np.ndarray) and
+              v.ndim > 0 and v.size > 0 and not v.dtype.hasobject}
+    _write_group(h5fid, title,
+                 {k: v for k, v in save_vars.items() if k not in arrays},
+                 comp_kw)
+    group = h5fid[title]
+    for name, value in arrays.items():
+        _write_array(group, name, value, storage, marker)
+
+
+def _save_with_storage(marker, fname, storage):
+    """Save a marker with its own save, and its arrays with the storage options
+
+    The marker is saved to a temporary file, and the groups written there
+    are copied to ``fname``, with the arrays of the fitted attributes
+    written again with the storage options.
+    """
+    objects = {marker._get_title(): marker}
+    estimator = getattr(marker, 'estimator', None)
+    if estimator is not None:
+        objects[estimator._get_title()] = estimator
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_fname = str(Path(tmp) / 'marker.hdf5')
+        marker.save(tmp_fname)
+        with h5py.File(tmp_fname, 'r') as tmp_h5fid, \
+                h5py.File(str(fname), 'a') as h5fid:
+            for title in _get_group_titles(tmp_h5fid):
+                if title == _CH_INFO_TITLE and title in h5fid:
+                    continue
+                if title in h5fid:
+                    del h5fid[title]
+                _copy_group(tmp_h5fid[title], h5fid, title, storage,
+                            objects.get(title, None))
+
+
+def _get_group_titles(h5fid):
+    """Titles of the groups written by h5io in a file"""
+    titles = []
+
+    def _visit(name, node):
+        if (isinstance(node, h5py.Group) and 'TITLE' in node.attrs and
+                'TITLE' not in node.parent.attrs):
+            titles.append(name)
+    h5fid.visititems(_visit)
+    return titles
+
+
+def _copy_group(source, h5fid, title, storage, marker):
+    """Copy a group written by h5io, writing its arrays with the storage
+    options
+    """
+    group = h5fid.create_group(title)
+    for key, value in source.attrs.items():
+        group.attrs[key] = value
+    for key, node in source.items():
+        name = key[4:].replace('{FWDSLASH}', '/')
+        if (name.endswith('_') and isinstance(node, h5py.Dataset) and
+                _get_h5_title(node) == 'ndarray'):
+            value = node[()]
+            if value.ndim > 0 and value.size > 0 and not value.dtype.hasobject:
+                _write_array(group, name, value, storage, marker)
+                continue
+        source.copy(node, group, name=key)
+
+
+def _write_array(group, name, value, storage, marker):
+    """Write an array of a marker group, as h5io would, with the storage
+    options
+    """
+    if (name == 'data_' and storage['dtype'] == 'float32' and
+            value.dtype in _DOWNCAST):
+        value = value.astype(_DOWNCAST[value.dtype])
+    kwargs = dict(shuffle=storage['shuffle'])
+    if storage['compression'] is not None:
+        kwargs['compression'] = storage['compression']
+        if storage['compression'] == 'gzip':
+            kwargs['compression_opts'] = storage['compression_opts']
+    if name == 'data_' and storage['chunks'] is not None:
+        kwargs['chunks'] = _get_chunks(marker, value.shape, storage['chunks'])
+    dataset = group.create_dataset(
+        'key_' + name.replace('/', '{FWDSLASH}'), data=value, **kwargs)
+    dataset.attrs['TITLE'] = 'ndarray'
+
+
+def _get_chunks(marker, shape, chunks):
+    """Chunk shape of data_ from the chunk lengths of some of its axes
+
+    The axes that the marker does not have are ignored, so that the same
+    chunks can be given for a whole collection.
+    """
+    axis_map = getattr(marker, '_axis_map', None)
+    if axis_map is None or len(axis_map) != len(shape):
+        # e.g. estimators, or packed connectivity: the chunks are chosen by
+        # h5py
+        return True
+    out = list(shape)
+    for axis, length in chunks.items():
+        if axis in axis_map and length is not None:
+            out[axis_map[axis]] = max(1, min(length, shape[axis_map[axis]]))
+    return tuple(out)
+
+
+def save_markers(markers, fname, overwrite=False, storage=None):
+    """Save a collection of markers to one HDF5 file
+
+    Parameters
+    ----------
+    markers : list | dict | instance of Markers
+        The markers to save, with the markers and estimators they depend on.
+    fname : str | Path
+        The file to write.
+    overwrite : bool | 'update'
+        If True, the file is replaced. If 'update', the markers are added to
+        the file. If False, the file must not exist.
+    storage : dict | None
+        How to store the arrays of the markers (compression, chunks...). See
+        ``HDF5Writer``.
+    """
+    if isinstance(markers, dict):
+        markers = markers.values()
+    with HDF5Writer(fname, overwrite=overwrite, storage=storage) as writer:
+        for marker in markers:
+            writer.add(marker)
+
+
+class LazyDataset(object):
+    """An array of an HDF5 file, read when needed
+
+    Parameters
+    ----------
+    fname : Path
+        The file.
+    path : str
+        The path of the dataset in the file.
+    """
+
+    def __init__(self, fname, path):
+        self.fname = fname
+        self.path = path
+        with h5py.File(str(fname), 'r') as h5fid:
+            dataset = h5fid[path]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            self.chunks = dataset.chunks
+            # Only set for contiguous datasets, as written by h5io
+            self.offset = dataset.id.get_offset()
+
+    def load(self):
+        """The array, memory mapped if the dataset is contiguous
+
+        The memory map is copy on write: changing the array does not change
+        the file.
+        """
+        if self.offset is not None and self.dtype.hasobject is False:
+            return np.memmap(str(self.fname), dtype=self.dtype, mode='c',
+                             offset=self.offset, shape=self.shape)
+        with h5py.File(str(self.fname), 'r') as h5fid:
+            return h5fid[self.path][()]
+
+
+def _read_group(fname, title, lazy=False):
+    """Read a group written by write_hdf5 with slash='replace'
+
+    If lazy, the arrays of the fitted attributes (ending with _) are
+    returned as LazyDataset.
+    """
+    with h5py.File(str(fname), 'r') as h5fid:
+        if title not in h5fid:
+            raise ValueError('no "{}" data found'.format(title))
+        node = h5fid[title]
+        if not lazy:
+            return _triage_read(node, slash='replace')
+        data = dict()
+        for key, subnode in node.items():
+            name = key[4:].replace('{FWDSLASH}', '/')
+            if (name.endswith('_') and isinstance(subnode, h5py.Dataset) and
+                    _get_h5_title(subnode) == 'ndarray'):
+                data[name] = LazyDataset(fname, subnode.name)
+            else:
+                data[name] = _triage_read(subnode, slash='replace')
+    return data
+
+
+def _read_ch_info(fname):
+    """The channel info of a file, shared by all the markers read from it
+
+    It is parsed again only if the file changed since it was last read.
+    """
+    fname = Path(fname).resolve()
+    stat = fname.stat()
+    key = (str(fname), stat.st_mtime_ns, stat.st_size)
+    info = _ch_info_cache.get(key, None)
+    if info is None:
+        file_info = _read_group(fname, _CH_INFO_TITLE)
+        if 'filename' in file_info:
+            del file_info['filename']
+        info = Info(file_info)
+        _ch_info_cache[key] = info
+    return info
+
+
+def _get_h5_title(node):
+    title = node.attrs['TITLE']
+    if isinstance(title, bytes):
+        title = title.decode()
+    return title
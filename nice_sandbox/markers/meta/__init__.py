@@ -22,7 +22,14 @@
 
 from . ratio import Ratio, read_ratio
 from . passthrough import Passthrough, read_passthrough
+from . ratio_bank import RatioBank, read_ratio_bank
+from . expression import Expression, read_expression
 from nice.collection import register_marker_class
+from nice.markers.spectral import PowerSpectralDensityEstimator
 
 register_marker_class(Ratio)
 register_marker_class(Passthrough)
+register_marker_class(RatioBank)
+register_marker_class(Expression)
+# Read as the estimator of RatioBank markers
+register_marker_class(PowerSpectralDensityEstimator)
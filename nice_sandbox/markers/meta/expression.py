@@ -0,0 +1,306 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import ast
+import sys
+from collections import OrderedDict
+import numpy as np
+
+from mne.utils import logger
+
+from ...markers.base import (BaseMarkerSandbox, _read_container, _is_fitted,
+                             _read_marker)
+from ..cache import _fit_marker
+from ..reduction import _get_reduction_plan, _reduce_split
+
+# Upper bound for the intermediate buffers of an evaluation
+_BUFFER_BYTES = 64 * 1024 ** 2
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+
+_FUNCTIONS = {
+    'abs': np.absolute,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'log2': np.log2,
+    'sqrt': np.sqrt,
+}
+
+
+class Expression(BaseMarkerSandbox):
+    """Arithmetic expression of markers
+
+    ``inputs`` maps names to markers with the same axes, and
+    ``expression`` combines them with ``+``, ``-``, ``*``, ``/``, ``**``,
+    numbers and the functions abs, exp, log, log10, log2 and sqrt, e.g.
+    ``'log(a / b)'`` or ``'(a - b) / (a + b)'``.
+
+    The expression is compiled to a sequence of in-place ufuncs and
+    evaluated in chunks of the first axis, into a few buffers that are
+    allocated once and reused, so no full-size temporaries are created.
+
+    As with ``Ratio``, the inputs are reduced separately over all the axes
+    but epochs and channels before the expression is evaluated.
+    """
+
+    # No data of its own: the parents are fit instead
+    _cache_fit = False
+
+    def __init__(self, inputs=None, expression=None, comment='default'):
+        BaseMarkerSandbox.__init__(
+            self, tmin=None, tmax=None, comment=comment)
+        if expression is not None:
+            _compile_expression(
+                expression, None if inputs is None else list(inputs))
+        self.inputs = inputs
+        self.expression = expression
+        self._check()
+
+    @property
+    def _axis_map(self):
+        return list(self.inputs.values())[0]._axis_map
+
+    def _check(self):
+        if self.inputs is not None and len(self.inputs) > 0:
+            axis_maps = [list(marker._axis_map.items())
+                         for marker in self.inputs.values()]
+            if any(x != axis_maps[0] for x in axis_maps[1:]):
+                raise ValueError('All the input markers must have the same '
+                                 'shape.')
+
+    def _fit(self, epochs):
+        if not self.inputs:
+            raise ValueError('Need inputs to be able to fit')
+        if self.expression is None:
+            raise ValueError('Need an expression to be able to fit')
+        self._check()
+
+        for name, marker in self.inputs.items():
+            if not _is_fitted(marker):
+                logger.warning(
+                    'Input {} not fit. If this is part of a feature '
+                    'collection, it should be placed after the corresponding '
+                    'estimator.'.format(name))
+                _fit_marker(marker, epochs)
+
+    def is_fitted(self):
+        """Whether all the inputs are fit, without touching ``data_``"""
+        return (bool(self.inputs) and
+                all(_is_fitted(marker) for marker in self.inputs.values()))
+
+    @property
+    def data_(self):
+        # Kept while the inputs data_ are the same arrays, as in Ratio
+        if not self.is_fitted():
+            raise AttributeError('data_')
+        names = list(self.inputs)
+        arrays = [self.inputs[name].data_ for name in names]
+        cache = getattr(self, '_data_cache', None)
+        if (cache is None or len(cache[0]) != len(arrays) or
+                any(x is not y for x, y in zip(cache[0], arrays))):
+            program = _compile_expression(self.expression, names)
+            cache = (arrays, _evaluate_expression(
+                program, dict(zip(names, arrays))))
+            self._data_cache = cache
+        return cache[1]
+
+    def _reduce_to(self, reduction_func, target, picks):
+        """ Reduce expression
+
+        As for Ratio, the inputs are first reduced separately until only
+        epochs and channels dimensions are left.
+
+        """
+        if not self.is_fitted():
+            raise ValueError('You did not fit me. Do it again after fitting '
+                             'some data!')
+        plan = _get_reduction_plan(self, reduction_func, target, split=True)
+        data = OrderedDict(
+            (name, marker._prepare_data(picks, target))
+            for name, marker in self._get_reduction_inputs().items())
+        return _reduce_split(plan, data, self._combine_reduced)
+
+    def _get_reduction_inputs(self):
+        return OrderedDict(self.inputs)
+
+    def _combine_reduced(self, data):
+        return _evaluate_expression(
+            _compile_expression(self.expression, list(data)), data)
+
+    def _get_save_group(self):
+        save_vars = self._get_save_vars(
+            exclude=['data_', '_data_cache', 'inputs', 'tmin', 'tmax'])
+        # The inputs are written by the HDF5Writer
+        save_vars['input_names_'] = {
+            name: marker._get_title() for name, marker in self.inputs.items()}
+        return self._get_title(), save_vars
+
+    @classmethod
+    def _read(cls, fname, markers=None, comment='default'):
+        return _read_expression(
+            cls, fname=fname, markers=markers, comment=comment)
+
+
+def _compile_expression(expression, names=None):
+    """Compile an expression into a sequence of in-place ufuncs
+
+    Returns (instructions, n_buffers, result). Each instruction is
+    (ufunc, operands, out). Operands are ('input', name), ('const', value)
+    or ('buffer', index); out is ('buffer', index) or ('out', None), the
+    output array. A buffer is reused as soon as its value has been read.
+    result is the operand holding the value if there are no instructions.
+    If names is None, any name is accepted.
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        raise ValueError('Invalid expression: {}'.format(expression))
+    instructions = []
+    free = []
+    n_buffers = [0]  # allocated so far
+
+    def _release(operand):
+        if operand[0] == 'buffer':
+            free.append(operand[1])
+
+    def _emit(ufunc, operands):
+        if all(x[0] == 'const' for x in operands):
+            # Fold constants
+            return ('const', ufunc(*[x[1] for x in operands]))
+        for operand in operands:
+            _release(operand)
+        if len(free) > 0:
+            out = ('buffer', free.pop())
+        else:
+            out = ('buffer', n_buffers[0])
+            n_buffers[0] += 1
+        instructions.append((ufunc, operands, out))
+        return out
+
+    def _visit(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return _emit(_BINARY_OPS[type(node.op)],
+                         [_visit(node.left), _visit(node.right)])
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return _emit(np.negative, [_visit(node.operand)])
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return _visit(node.operand)
+        elif (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Name) and
+                node.func.id in _FUNCTIONS and len(node.args) == 1 and
+                len(node.keywords) == 0):
+            return _emit(_FUNCTIONS[node.func.id], [_visit(node.args[0])])
+        elif isinstance(node, ast.Name):
+            if names is not None and node.id not in names:
+                raise ValueError('Unknown input in expression: {}'.format(
+                    node.id))
+            return ('input', node.id)
+        elif _get_number(node) is not None:
+            return ('const', _get_number(node))
+        raise ValueError('Unsupported element in expression {}: {}'.format(
+            expression, type(node).__name__))
+
+    result = _visit(tree.body)
+    if len(instructions) == 0:
+        return instructions, 0, result
+    # The last instruction writes into the output array
+    ufunc, operands, _ = instructions[-1]
+    instructions[-1] = (ufunc, operands, ('out', None))
+    used = [x[1] for _, ops, out in instructions for x in ops + [out]
+            if x[0] == 'buffer']
+    return instructions, max(used + [-1]) + 1, result
+
+
+def _get_number(node):
+    """Value of a number node of the expression, None for other nodes"""
+    # Numbers are ast.Num nodes up to Python 3.7, ast.Constant afterwards
+    if sys.version_info < (3, 8):
+        value = node.n if isinstance(node, ast.Num) else None
+    else:
+        value = node.value if isinstance(node, ast.Constant) else None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+def _evaluate_expression(program, inputs, max_bytes=_BUFFER_BYTES):
+    """Evaluate a compiled expression in chunks of the first axis"""
+    instructions, n_buffers, result = program
+    arrays = list(inputs.values())
+    shape = np.broadcast(*arrays).shape if len(arrays) > 0 else ()
+    dtype = np.result_type(np.float64, *arrays)
+    out = np.empty(shape, dtype=dtype)
+    if len(instructions) == 0:
+        # Name or number: nothing to compute
+        out[...] = inputs[result[1]] if result[0] == 'input' else result[1]
+        return out
+    if len(shape) == 0:
+        arrays = {k: np.asarray(v)[np.newaxis] for k, v in inputs.items()}
+        return _evaluate_expression(program, arrays, max_bytes)[0]
+
+    row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+    step = int(max(min(max_bytes // max(row_bytes * max(n_buffers, 1), 1),
+                       shape[0]), 1))
+    buffers = [np.empty((step,) + shape[1:], dtype=dtype)
+               for _ in range(n_buffers)]
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        chunk = {k: np.broadcast_to(v, shape)[start:stop]
+                 for k, v in inputs.items()}
+
+        def _get(operand):
+            kind, value = operand
+            if kind == 'input':
+                return chunk[value]
+            elif kind == 'const':
+                return value
+            elif kind == 'buffer':
+                return buffers[value][:stop - start]
+            return out[start:stop]
+
+        for ufunc, operands, target in instructions:
+            ufunc(*[_get(x) for x in operands], out=_get(target))
+    return out
+
+
+def _read_expression(cls, fname, markers=None, comment='default'):
+    out = _read_container(cls, fname, comment=comment)
+    if markers is None:
+        markers = {}
+
+    out.inputs = {name: _read_marker(fname, title, markers)
+                  for name, title in out.input_names_.items()}
+    del out.input_names_
+    out._check()
+    return out
+
+
+def read_expression(fname, markers=None, comment='default'):
+    out = Expression._read(fname, markers=markers, comment=comment)
+    return out
@@ -20,19 +20,39 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 
-from pathlib import Path
-import h5py
+import numpy as np
+
 from mne.utils import logger
-from mne.externals.h5io import write_hdf5
 
-from ...markers.base import BaseMarkerSandbox, _read_container
+from ...markers.base import (BaseMarkerSandbox, _read_container, _is_fitted,
+                             _read_marker)
+from ..cache import _fit_marker
+from ..reduction import _get_reduction_plan
 
 
 class Passthrough(BaseMarkerSandbox):
-    def __init__(self, parent=None, comment='default'):
+    """Exposes the data of a parent marker, or a selection of it
+
+    ``selection`` maps axis names of the parent to what to keep on each
+    axis: a slice, an array of indices, a boolean mask or, on the
+    ``frequency`` axis of a parent with ``freqs_``, a band as
+    ``{'fmin': fmin, 'fmax': fmax}`` (the frequencies in [fmin, fmax)).
+    The selection is applied when the data is prepared, as views of the
+    parent data when possible (slices, and indices or masks that are
+    evenly spaced). Only the selection is saved, not the data.
+    """
+
+    # No data of its own: the parents are fit instead
+    _cache_fit = False
+
+    def __init__(self, parent=None, selection=None, comment='default'):
         BaseMarkerSandbox.__init__(
             self, tmin=None, tmax=None, comment=comment)
+        if selection is not None:
+            selection = {axis: _encode_selection(axis, spec)
+                         for axis, spec in selection.items()}
         self.parent = parent
+        self.selection = selection
         self._check()
 
     @property
@@ -40,53 +60,75 @@ class Passthrough(BaseMarkerSandbox):
         return self.parent._axis_map
 
     def _check(self):
-        # Nothing to check for the moment
-        pass
+        if self.parent is not None and self.selection is not None:
+            unknown = [x for x in self.selection
+                       if x not in self.parent._axis_map]
+            if len(unknown) > 0:
+                raise ValueError('Cannot select on axes {} of {}'.format(
+                    unknown, self.parent._get_title()))
 
     def _fit(self, epochs):
         if self.parent is None:
             raise ValueError('Need a parent to be able to fit')
         self._check()
 
-        if not hasattr(self.parent, 'data_'):
+        if not _is_fitted(self.parent):
             logger.warning(
                 'Parent not fit. If this is part of a feature collection, '
                 'it should be placed after the corresponding estimator.')
-            self.parent.fit(epochs)
+            _fit_marker(self.parent, epochs)
+
+    def is_fitted(self):
+        """Whether the parent is fit, without touching ``data_``"""
+        return self.parent is not None and _is_fitted(self.parent)
 
     @property
     def data_(self):
-        logger.warning('This attribute should not be accessed directly '
-                       'as it depends on the parent data_ '
-                       'attribute')
-        return self.parent.data_
-
-    def save(self, fname, overwrite=False):
-        if not isinstance(fname, Path):
-            fname = Path(fname)
-        self._save_info(fname, overwrite=overwrite)
+        if not self.is_fitted():
+            raise AttributeError('data_')
+        if self.selection is None:
+            return self.parent.data_
+        return self._prepare_data(None, 'scalar')
+
+    def _reduce_to(self, reduction_func, target, picks):
+        """ Reduce the parent data with a cached reduction plan """
+        if not self.is_fitted():
+            raise ValueError('You did not fit me. Do it again after fitting '
+                             'some data!')
+        plan = _get_reduction_plan(self, reduction_func, target)
+        return plan.reduce(self._prepare_data(picks, target))
+
+    def _prepare_data(self, picks, target):
+        if self.selection is None:
+            return self.parent._prepare_data(picks, target)
+        data = self.parent._prepare_data(None, target)
+        _axis_map = self._axis_map
+        for axis, spec in self.selection.items():
+            this_axis = _axis_map[axis]
+            index = _resolve_selection(
+                axis, spec, data.shape[this_axis],
+                _get_parent_freqs(self.parent))
+            data = data[(slice(None),) * this_axis + (index,)]
+        if picks is None:
+            return data
+        if any([x not in _axis_map for x in picks.keys()]):
+            raise ValueError('Picking is not compatible for {}'.format(
+                self._get_title()))
+        to_preserve = self._get_preserve_axis(target)
+        for axis, ax_picks in picks.items():
+            if axis in to_preserve or ax_picks is None:
+                continue
+            this_axis = _axis_map[axis]
+            data = (data.swapaxes(this_axis, 0)[ax_picks, ...]
+                    .swapaxes(0, this_axis))
+        return data
+
+    def _get_save_group(self):
         save_vars = self._get_save_vars(
             exclude=['data_', 'parent', 'tmin', 'tmax'])
-
-        parent_name = self.parent._get_title()
-
-        save_vars['parent_name_'] = parent_name
-
-        has_parent = False
-
-        with h5py.File(fname) as h5fid:
-            if parent_name in h5fid:
-                has_parent = True
-                logger.info('Parent already present in HDF5 file, '
-                            'will not be overwritten')
-
-        if not has_parent:
-            logger.info('Writing numerator to HDF5 file')
-            self.parent.save(fname, overwrite=overwrite)
-
-        write_hdf5(
-            fname, save_vars, overwrite=overwrite,
-            title=self._get_title(), slash='replace')
+        # The parent is written by the HDF5Writer
+        save_vars['parent_name_'] = self.parent._get_title()
+        return self._get_title(), save_vars
 
     @classmethod
     def _read(cls, fname, markers=None, comment='default'):
@@ -94,15 +136,79 @@ class Passthrough(BaseMarkerSandbox):
             cls, fname=fname, markers=markers, comment=comment)
 
 
+def _encode_selection(axis, spec):
+    # Saveable form: slices and bands as dicts, indices and masks as arrays
+    if isinstance(spec, slice):
+        spec = dict(start=spec.start, stop=spec.stop, step=spec.step)
+    if isinstance(spec, dict):
+        if set(spec) == set(['start', 'stop', 'step']):
+            return spec
+        if set(spec) == set(['fmin', 'fmax']):
+            if axis != 'frequency' or spec['fmin'] >= spec['fmax']:
+                raise ValueError('Bands can only be selected on the '
+                                 'frequency axis, with fmin < fmax.')
+            return dict(fmin=float(spec['fmin']), fmax=float(spec['fmax']))
+        raise ValueError('Invalid selection on {}: {}'.format(axis, spec))
+    spec = np.asarray(spec)
+    if spec.ndim != 1 or not (spec.dtype == bool or
+                              np.issubdtype(spec.dtype, np.integer)):
+        raise ValueError('Invalid selection on {}: {}. Use a slice, an '
+                         'array of indices or a boolean mask.'.format(
+                             axis, spec))
+    return spec
+
+
+def _get_parent_freqs(parent):
+    # Frequencies along the frequency axis of the parent data, if known
+    freqs = getattr(parent, 'freqs_', None)
+    estimator = getattr(parent, 'estimator', None)
+    if freqs is None and hasattr(estimator, 'freqs_'):
+        # Spectral markers slice the estimator frequencies to [fmin, fmax]
+        freqs = estimator.freqs_
+        start = np.searchsorted(freqs, getattr(parent, 'fmin', None) or 0,
+                                'left')
+        end = np.searchsorted(freqs, getattr(parent, 'fmax', None) or np.inf,
+                              'right')
+        freqs = freqs[start:end]
+    return freqs
+
+
+def _resolve_selection(axis, spec, n_items, freqs=None):
+    """Index of a selection: a slice when possible, so data[index] is a
+    view, an array of indices otherwise"""
+    if isinstance(spec, dict) and 'fmin' in spec:
+        if freqs is None or len(freqs) != n_items:
+            raise ValueError('Cannot select a band: the frequency axis '
+                             'does not match the parent freqs_.')
+        spec = (freqs >= spec['fmin']) & (freqs < spec['fmax'])
+        if not np.any(spec):
+            raise ValueError('There are no frequency points in the '
+                             'selected band.')
+    if isinstance(spec, dict):
+        return slice(spec['start'], spec['stop'], spec['step'])
+    if spec.dtype == bool:
+        if len(spec) != n_items:
+            raise ValueError('The mask on {} has {} elements instead of '
+                             '{}.'.format(axis, len(spec), n_items))
+        spec = np.flatnonzero(spec)
+    spec = np.where(spec < 0, spec + n_items, spec)
+    if len(spec) > 0 and (spec.min() < 0 or spec.max() >= n_items):
+        raise ValueError('Selection out of range on {}'.format(axis))
+    if len(spec) == 1:
+        return slice(spec[0], spec[0] + 1)
+    if len(spec) > 1:
+        step = spec[1] - spec[0]
+        if step > 0 and np.all(np.diff(spec) == step):
+            return slice(spec[0], spec[-1] + 1, step)
+    return spec
+
+
 def _read_passthrough(cls, fname, markers=None, comment='default'):
     out = _read_container(cls, fname, comment=comment)
     if markers is None:
-        # Get class of each estimator and read
-        raise NotImplementedError(
-            'This feature is not yet implemented. Please read all the '
-            'markers first')
+        markers = {}
 
-    out.parent = markers[out.parent_name_]
+    out.parent = _read_marker(fname, out.parent_name_, markers)
     del out.parent_name_
     return out
 
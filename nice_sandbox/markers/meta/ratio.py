@@ -20,17 +20,20 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 
-from pathlib import Path
-import numpy as np
+from collections import OrderedDict
 
-import h5py
 from mne.utils import logger
-from mne.externals.h5io import write_hdf5
 
-from ...markers.base import BaseMarkerSandbox, _read_container
+from ...markers.base import (BaseMarkerSandbox, _read_container, _is_fitted,
+                             _read_marker)
+from ..cache import _fit_marker
+from ..reduction import _get_reduction_plan, _reduce_split
 
 
 class Ratio(BaseMarkerSandbox):
+    # No data of its own: the parents are fit instead
+    _cache_fit = False
+
     def __init__(self, numerator=None, denominator=None, comment='default'):
         BaseMarkerSandbox.__init__(
             self, tmin=None, tmax=None, comment=comment)
@@ -59,67 +62,41 @@ class Ratio(BaseMarkerSandbox):
 
         self._check()
 
-        if not hasattr(self.numerator, 'data_'):
+        if not _is_fitted(self.numerator):
             logger.warning(
                 'Numerator not fit. If this is part of a feature collection, '
                 'it should be placed after the corresponding estimator.')
-            self.numerator.fit(epochs)
-        if not hasattr(self.denominator, 'data_'):
+            _fit_marker(self.numerator, epochs)
+        if not _is_fitted(self.denominator):
             logger.warning(
                 'Denominator not fit. If this is part of a feature collection,'
                 ' it should be placed after the corresponding estimator.')
-            self.denominator.fit(epochs)
+            _fit_marker(self.denominator, epochs)
+
+    def is_fitted(self):
+        """Whether the numerator and denominator are fit
+
+        Cheap: it does not compute ``data_``.
+        """
+        return (self.numerator is not None and
+                self.denominator is not None and
+                _is_fitted(self.numerator) and _is_fitted(self.denominator))
 
     @property
     def data_(self):
-        logger.warning('This attribute should not be accessed directly '
-                       'as it depends on the numerator/denominator data_ '
-                       'attribute')
-        return self.numerator.data_ / self.denominator.data_
-
-    def _prepare_reduction(self, reduction_func, target, picks):
-        data_numerator = self.numerator._prepare_data(picks, target)
-        data_denominator = self.denominator._prepare_data(picks, target)
-        _axis_map = self._axis_map
-        funcs = list()
-        axis = []
-        axis_to_preserve = self._get_preserve_axis(target)
-        if len(axis_to_preserve) > 0:
-            removed_axis = []
-            for this_axis_to_preserve in axis_to_preserve:
-                removed_axis.append(_axis_map.pop(this_axis_to_preserve))
-            if reduction_func is not None:
-                reduction_func = [i for i in reduction_func
-                                  if i['axis'] not in axis_to_preserve]
-        permutation_list = list()
-        if reduction_func is None:
-            for remaining_axis in _axis_map.values():
-                permutation_list.append(remaining_axis)
-                funcs.append(np.mean)
-                axis.append(remaining_axis)
-        elif len(reduction_func) == len(_axis_map):
-            for rec in reduction_func:
-                this_axis = _axis_map.pop(rec['axis'])
-                permutation_list.append(this_axis)
-                funcs.append(rec['function'])
-                axis.append(rec['axis'])
-        else:
-            raise ValueError('Run `python -c "import this"` to see '
-                             'why we will not tolerate these things')
-        if len(axis_to_preserve) > 0:
-            permutation_list += removed_axis  # type: ignore
-
-        found = False
-        for t_ax in axis:
-            if t_ax in ['epochs', 'channels'] and found is False:
-                found = True
-            if found is True and t_ax not in ['epochs', 'channels']:
-                raise ValueError('Cannot reduce Ratio marker with this axis '
-                                 'order. Channels and Epochs should be the '
-                                 'two last axis to reduce (in any order).')
-        data_numerator = np.transpose(data_numerator, permutation_list)
-        data_denominator = np.transpose(data_denominator, permutation_list)
-        return (data_numerator, data_denominator), funcs, axis
+        # The ratio is computed once and kept while the numerator and
+        # denominator data_ are the same arrays. Refitting them creates new
+        # arrays, which invalidates it. In place changes are not detected.
+        if not self.is_fitted():
+            raise AttributeError('data_')
+        numerator = self.numerator.data_
+        denominator = self.denominator.data_
+        cache = getattr(self, '_data_cache', None)
+        if (cache is None or cache[0] is not numerator or
+                cache[1] is not denominator):
+            cache = (numerator, denominator, numerator / denominator)
+            self._data_cache = cache
+        return cache[2]
 
     def _reduce_to(self, reduction_func, target, picks):
         """ Reduce ratio
@@ -128,60 +105,34 @@ class Ratio(BaseMarkerSandbox):
         numerator and denominator separately until only epochs and channels
         dimensions are left.
 
+        The reduction plan is computed once for each recipe and target (see
+        ``nice_sandbox.markers.reduction``).
+
         """
-        if not hasattr(self, 'data_'):
+        if not self.is_fitted():
             raise ValueError('You did not fit me. Do it again after fitting '
                              'some data!')
-        (data_num, data_den), funcs, axis = self._prepare_reduction(
-            reduction_func, target, picks)
-
-        out = None
-        for func, ax in zip(funcs, axis):
-            if ax not in ['channels', 'epochs']:
-                data_num = func(data_num, axis=0)
-                data_den = func(data_den, axis=0)
-            else:
-                if out is None:
-                    out = data_num / data_den
-                out = func(out, axis=0)
-        return out
-
-    def save(self, fname, overwrite=False):
-        if not isinstance(fname, Path):
-            fname = Path(fname)
-        self._save_info(fname, overwrite=overwrite)
+        plan = _get_reduction_plan(self, reduction_func, target, split=True)
+        data = OrderedDict(
+            (name, marker._prepare_data(picks, target))
+            for name, marker in self._get_reduction_inputs().items())
+        return _reduce_split(plan, data, self._combine_reduced)
+
+    def _get_reduction_inputs(self):
+        return OrderedDict([('numerator', self.numerator),
+                            ('denominator', self.denominator)])
+
+    def _combine_reduced(self, data):
+        return data['numerator'] / data['denominator']
+
+    def _get_save_group(self):
         save_vars = self._get_save_vars(
-            exclude=['data_', 'numerator', 'denominator', 'tmin', 'tmax'])
-
-        numerator_name = self.numerator._get_title()
-        denominator_name = self.denominator._get_title()
-
-        save_vars['numerator_name_'] = numerator_name
-        save_vars['denominator_name_'] = denominator_name
-
-        has_numerator = False
-        has_denominator = False
-
-        with h5py.File(fname) as h5fid:
-            if numerator_name in h5fid:
-                has_numerator = True
-                logger.info('Numerator already present in HDF5 file, '
-                            'will not be overwritten')
-            if denominator_name in h5fid:
-                has_denominator = True
-                logger.info('Denominator already present in HDF5 file, '
-                            'will not be overwritten')
-
-        if not has_numerator:
-            logger.info('Writing numerator to HDF5 file')
-            self.numerator.save(fname, overwrite=overwrite)
-        if not has_denominator:
-            logger.info('Writing denominator to HDF5 file')
-            self.denominator.save(fname, overwrite=overwrite)
-
-        write_hdf5(
-            fname, save_vars, overwrite=overwrite,
-            title=self._get_title(), slash='replace')
+            exclude=['data_', '_data_cache', 'numerator', 'denominator',
+                     'tmin', 'tmax'])
+        # The numerator and denominator are written by the HDF5Writer
+        save_vars['numerator_name_'] = self.numerator._get_title()
+        save_vars['denominator_name_'] = self.denominator._get_title()
+        return self._get_title(), save_vars
 
     @classmethod
     def _read(cls, fname, markers=None, comment='default'):
@@ -191,13 +142,10 @@ class Ratio(BaseMarkerSandbox):
 def _read_ratio(cls, fname, markers=None, comment='default'):
     out = _read_container(cls, fname, comment=comment)
     if markers is None:
-        # Get class of each estimator and read
-        raise NotImplementedError(
-            'This feature is not yet implemented. Please read all the '
-            'markers first')
+        markers = {}
 
-    out.numerator = markers[out.numerator_name_]
-    out.denominator = markers[out.denominator_name_]
+    out.numerator = _read_marker(fname, out.numerator_name_, markers)
+    out.denominator = _read_marker(fname, out.denominator_name_, markers)
     del out.numerator_name_
     del out.denominator_name_
     return out
@@ -0,0 +1,124 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+from collections import OrderedDict
+import numpy as np
+
+from mne.utils import logger
+
+from ...markers.base import (BaseMarkerSandbox, _read_container,
+                             _read_marker)
+from ..cache import _fit_marker
+
+
+class RatioBank(BaseMarkerSandbox):
+    """Ratios of the power in pairs of bands of one PSD estimator
+
+    ``pairs`` is a list of ((fmin, fmax), (fmin, fmax)) tuples, the
+    numerator and denominator bands of each ratio. The power in a band is
+    the sum of the PSD over the frequencies in [fmin, fmax], the ones kept
+    by a PowerSpectralDensity marker of that band. All the band
+    sums are taken from the cumulative sum of the PSD, in a single pass, so
+    ``data_`` holds every ratio at once, with shape
+    (n_epochs, n_channels, n_ratios).
+    """
+
+    def __init__(self, estimator=None, pairs=None, comment='default'):
+        BaseMarkerSandbox.__init__(
+            self, tmin=None, tmax=None, comment=comment)
+        if pairs is not None:
+            pairs = [tuple(tuple(float(f) for f in band) for band in pair)
+                     for pair in pairs]
+            for pair in pairs:
+                if (len(pair) != 2 or
+                        any(len(band) != 2 or band[0] >= band[1]
+                            for band in pair)):
+                    raise ValueError('Pairs must be ((fmin, fmax), '
+                                     '(fmin, fmax)) tuples with fmin < fmax.')
+        self.estimator = estimator
+        self.pairs = pairs
+
+    @property
+    def _axis_map(self):
+        return OrderedDict([
+            ('epochs', 0),
+            ('channels', 1),
+            ('ratio', 2)
+        ])
+
+    def _fit(self, epochs):
+        if self.estimator is None:
+            raise ValueError('Need an estimator to be able to fit')
+        if not self.pairs:
+            raise ValueError('Need band pairs to be able to fit')
+        if not hasattr(self.estimator, 'data_'):
+            logger.info('PSDS Estimator not fit. Fitting it now.')
+            _fit_marker(self.estimator, epochs)
+        psds = self.estimator.data_
+        freqs = self.estimator.freqs_
+
+        # Each distinct band is summed once: [lo, hi) frequency bins, with
+        # both edges of the band included
+        bands = sorted(set(band for pair in self.pairs for band in pair))
+        lo = np.searchsorted(freqs, [band[0] for band in bands], 'left')
+        hi = np.searchsorted(freqs, [band[1] for band in bands], 'right')
+        for band, band_lo, band_hi in zip(bands, lo, hi):
+            if band_lo == band_hi:
+                raise ValueError('There are no frequency points between '
+                                 '{}Hz and {}Hz.'.format(*band))
+        cum_psds = np.zeros(psds.shape[:-1] + (psds.shape[-1] + 1,))
+        np.cumsum(psds, axis=-1, out=cum_psds[..., 1:])
+        band_sums = cum_psds[..., hi] - cum_psds[..., lo]
+
+        numerators = [bands.index(pair[0]) for pair in self.pairs]
+        denominators = [bands.index(pair[1]) for pair in self.pairs]
+        self.data_ = band_sums[..., numerators] / band_sums[..., denominators]
+        self.freqs_ = freqs
+
+    def _get_save_group(self):
+        save_vars = self._get_save_vars(
+            exclude=['ch_info_', 'estimator', 'tmin', 'tmax'])
+        # The estimator is written by the HDF5Writer
+        save_vars['estimator_name_'] = self.estimator._get_title()
+        return self._get_title(), save_vars
+
+    @classmethod
+    def _read(cls, fname, comment='default', lazy=False, markers=None):
+        return _read_ratio_bank(cls, fname=fname, comment=comment, lazy=lazy,
+                                markers=markers)
+
+
+def _read_ratio_bank(cls, fname, comment='default', lazy=False,
+                     markers=None):
+    out = _read_container(cls, fname, comment=comment, lazy=lazy)
+    if markers is None:
+        markers = {}
+    # Shared with the other markers read with the same markers
+    out.estimator = _read_marker(fname, out.estimator_name_, markers,
+                                 lazy=lazy)
+    del out.estimator_name_
+    return out
+
+
+def read_ratio_bank(fname, comment='default', lazy=False, markers=None):
+    out = RatioBank._read(fname, comment=comment, lazy=lazy, markers=markers)
+    return out
@@ -0,0 +1,125 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+import numpy as np
+
+from numpy.testing import assert_array_almost_equal
+from nose.tools import assert_raises
+
+import functools
+
+import mne
+
+from nice.utils import create_mock_data_egi
+from nice.markers.tests.test_markers import _base_io_test
+from nice.markers.spectral import (PowerSpectralDensity,
+                                   PowerSpectralDensityEstimator)
+
+from nice_sandbox.markers.meta import Expression, read_expression
+
+n_epochs = 30
+raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
+
+triggers = np.arange(50, n_epochs * 386, 386)
+
+raw._data[-1].fill(0.0)
+raw._data[-1, triggers] = [10] * int(n_epochs / 2) + [20] * int(n_epochs / 2)
+
+events = mne.find_events(raw)
+event_id = {
+    'foo': 10,
+    'bar': 20,
+}
+epochs = mne.Epochs(raw, events, event_id, tmin=-.2, tmax=1.34,
+                    preload=True, reject=None, picks=None,
+                    baseline=(None, 0), verbose=False)
+epochs.drop_channels(['STI 014'])
+
+
+def test_expression():
+    """Test computation of Expression markers"""
+    psds_params = dict(n_fft=4096, n_overlap=100, n_jobs='auto',
+                       nperseg=128)
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=psds_params, comment='default'
+    )
+    psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4., comment='delta')
+    psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8., comment='theta')
+    markers = {
+        psd1._get_title(): psd1,
+        psd2._get_title(): psd2
+    }
+    expression = Expression(inputs={'delta': psd1, 'theta': psd2},
+                            expression='(delta - theta) / (delta + theta)',
+                            comment='norm_diff')
+
+    _base_io_test(expression, epochs,
+                  functools.partial(read_expression, markers=markers,
+                                    comment='norm_diff'))
+
+    data1 = psd1.data_
+    data2 = psd2.data_
+    assert_array_almost_equal(expression.data_,
+                              (data1 - data2) / (data1 + data2))
+
+    # As for Ratio, the inputs are reduced before the expression
+    red = [{'axis': 'frequency', 'function': np.sum},
+           {'axis': 'epochs', 'function': np.mean},
+           {'axis': 'channels', 'function': np.mean}]
+    log_ratio = Expression(inputs={'a': psd1, 'b': psd2},
+                           expression='log(a / b)')
+    topos = log_ratio.reduce_to_topo(reduction_func=red)
+
+    freq_ax = psd1._axis_map['frequency']
+    epochs_ax = psd1._axis_map['epochs']
+    data1 = psd1._prepare_data(target='scalar', picks=None)
+    data2 = psd2._prepare_data(target='scalar', picks=None)
+    data1 = data1.sum(axis=freq_ax)
+    data2 = data2.sum(axis=freq_ax)
+    assert_array_almost_equal(topos,
+                              np.log(data1 / data2).mean(axis=epochs_ax))
+
+    # Numeric constants
+    psd1_lin = PowerSpectralDensity(estimator, fmin=1., fmax=4., dB=False)
+    weighted = Expression(inputs={'a': psd1, 'b': psd1_lin},
+                          expression='0.5 * a + 0.5 * b')
+    weighted.fit(epochs)
+    assert_array_almost_equal(weighted.data_,
+                              0.5 * psd1.data_ + 0.5 * psd1_lin.data_)
+    scaled = Expression(inputs={'a': psd1},
+                        expression='-2 * a ** 2 + 1')
+    scaled.fit(epochs)
+    assert_array_almost_equal(scaled.data_, -2 * psd1.data_ ** 2 + 1)
+    assert_raises(ValueError, Expression, inputs={'a': psd1},
+                  expression='a * True')
+
+    assert_raises(ValueError, Expression, inputs={'a': psd1},
+                  expression='a / b')
+    assert_raises(ValueError, Expression, inputs={'a': psd1},
+                  expression='a.sum()')
+    assert_raises(ValueError, Expression, inputs={'a': psd1},
+                  expression='a +')
+
+
+if __name__ == "__main__":
+    import nose
+    nose.run(defaultTest=__name__)
@@ -23,6 +23,7 @@
 import numpy as np
 
 from numpy.testing import assert_array_equal
+from nose.tools import assert_true, assert_almost_equal, assert_raises
 
 import functools
 
@@ -129,6 +130,64 @@ def test_passthrough():
     assert pos_scalar == scalars[1]
 
 
+def test_passthrough_selection():
+    """Test Passthrough markers with axis selections"""
+    psds_params = dict(n_fft=4096, n_overlap=100, n_jobs='auto',
+                       nperseg=128)
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=psds_params, comment='default'
+    )
+    psd = PowerSpectralDensity(estimator, fmin=1., fmax=45., comment='all')
+    psd.fit(epochs)
+    markers = {psd._get_title(): psd}
+
+    freqs = estimator.freqs_
+    freqs = freqs[(freqs >= 1.) & (freqs <= 45.)]
+    band = (freqs >= 4.) & (freqs < 8.)
+    theta = Passthrough(
+        parent=psd, comment='theta',
+        selection={'frequency': {'fmin': 4., 'fmax': 8.},
+                   'channels': slice(0, 4)})
+    theta.fit(epochs)
+    assert_array_equal(theta.data_, psd.data_[:, :4][..., band])
+    # Contiguous selections are views of the parent data
+    assert_true(np.shares_memory(theta.data_, psd.data_))
+
+    # Evenly spaced indices and masks are views too
+    mask = np.zeros(psd.data_.shape[1], dtype=bool)
+    mask[[0, 2, 4]] = True
+    for selection in ([0, 2, 4], mask):
+        even = Passthrough(parent=psd, selection={'channels': selection})
+        even.fit(epochs)
+        assert_array_equal(even.data_, psd.data_[:, [0, 2, 4]])
+        assert_true(np.shares_memory(even.data_, psd.data_))
+
+    # Other index arrays are copied
+    odd = Passthrough(parent=psd, selection={'channels': [3, 0, 1]})
+    odd.fit(epochs)
+    assert_array_equal(odd.data_, psd.data_[:, [3, 0, 1]])
+
+    red = [
+        {'axis': 'frequency', 'function': np.sum},
+        {'axis': 'epochs', 'function': np.mean},
+        {'axis': 'channels', 'function': np.mean}]
+    assert_almost_equal(
+        theta.reduce_to_scalar(red, picks={'channels': [1, 2]}),
+        psd.data_[:, 1:3][..., band].sum(-1).mean(0).mean(0))
+
+    _base_io_test(theta, epochs,
+                  functools.partial(read_passthrough, markers=markers,
+                                    comment='theta'))
+
+    assert_raises(ValueError, Passthrough, parent=psd,
+                  selection={'times': slice(0, 2)})
+    assert_raises(ValueError, Passthrough, parent=psd,
+                  selection={'channels': {'fmin': 4., 'fmax': 8.}})
+    assert_raises(ValueError, Passthrough, parent=psd,
+                  selection={'channels': 2})
+
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__name__)
@@ -22,11 +22,15 @@
 
 import numpy as np
 
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from nose.tools import assert_true, assert_equal
 
 import functools
 
+import h5py
+
 import mne
+from mne.utils import _TempDir
 
 from nice.utils import create_mock_data_egi
 from nice.markers.tests.test_markers import _base_io_test
@@ -34,6 +38,9 @@ from nice.markers.spectral import (PowerSpectralDensity,
                                    PowerSpectralDensityEstimator)
 
 from nice_sandbox.markers.meta import Ratio, read_ratio
+from nice_sandbox.markers.reduction import _plans, _MAX_PLANS
+from nice_sandbox.markers.connectivity import (WeightedPhaseLagIndex,
+                                               CrossSpectralEstimator)
 
 n_epochs = 30
 raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
@@ -102,6 +109,156 @@ def test_ratio():
     assert_array_equal(topos_div, topos_ratio)
 
 
+def test_ratio_cache():
+    """Test the cached data of Ratio markers"""
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+        comment='default')
+    psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4., comment='delta')
+    psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8., comment='theta')
+    ratio = Ratio(numerator=psd1, denominator=psd2, comment='delta_theta')
+    assert_true(not ratio.is_fitted())
+    assert_true(not hasattr(ratio, 'data_'))
+
+    ratio.fit(epochs)
+    assert_true(ratio.is_fitted())
+    data = ratio.data_
+    assert_true(ratio.data_ is data)
+
+    # Refitting a parent invalidates the cache
+    psd1.fit(epochs)
+    assert_true(ratio.data_ is not data)
+    assert_array_equal(ratio.data_, psd1.data_ / psd2.data_)
+
+
+def test_ratio_reduction_plan():
+    """Test the cached reduction plans of Ratio markers"""
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+        comment='default')
+    psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4., comment='delta')
+    psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8., comment='theta')
+    ratio = Ratio(numerator=psd1, denominator=psd2, comment='delta_theta')
+    ratio.fit(epochs)
+
+    red_ratio = [{'axis': 'frequency', 'function': np.sum},
+                 {'axis': 'channels', 'function': np.mean},
+                 {'axis': 'epochs', 'function': np.median}]
+    data1 = psd1.data_.sum(axis=psd1._axis_map['frequency'])
+    data2 = psd2.data_.sum(axis=psd2._axis_map['frequency'])
+    scalar = np.median((data1 / data2).mean(axis=1))
+
+    # The second call reuses the plan and its buffers
+    scalar1 = ratio.reduce_to_scalar(reduction_func=red_ratio)
+    scalar2 = ratio.reduce_to_scalar(reduction_func=red_ratio)
+    assert_array_equal(scalar1, scalar)
+    assert_array_equal(scalar2, scalar)
+
+    topos1 = ratio.reduce_to_topo(reduction_func=red_ratio)
+    topos2 = ratio.reduce_to_topo(reduction_func=red_ratio)
+    assert_true(topos1 is not topos2)
+    assert_array_equal(topos1, np.median(data1 / data2, axis=0))
+    assert_array_equal(topos1, topos2)
+
+    # Recipes made again for each call reuse the plan of the same recipe
+    def _get_recipe(q):
+        return [{'axis': 'frequency',
+                 'function': lambda x, axis: np.sum(x, axis=axis)},
+                {'axis': 'channels', 'function': np.mean},
+                {'axis': 'epochs',
+                 'function': functools.partial(np.percentile, q=q)}]
+
+    ratio.reduce_to_scalar(reduction_func=_get_recipe(50))
+    n_plans = len(_plans[ratio])
+    scalar = ratio.reduce_to_scalar(reduction_func=_get_recipe(50))
+    assert_equal(len(_plans[ratio]), n_plans)
+    assert_array_equal(scalar, np.percentile((data1 / data2).mean(axis=1),
+                                             q=50))
+    # The number of plans kept is bounded
+    for q in range(2 * _MAX_PLANS):
+        ratio.reduce_to_scalar(reduction_func=_get_recipe(q))
+    assert_equal(len(_plans[ratio]), _MAX_PLANS)
+
+
+def test_ratio_read_dependencies():
+    """Test reading Ratio markers without reading their parents first"""
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+        comment='default')
+    psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4., comment='delta')
+    psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8., comment='theta')
+    ratio = Ratio(numerator=psd1, denominator=psd2, comment='delta_theta')
+    ratio2 = Ratio(numerator=ratio, denominator=psd2, comment='nested')
+    ratio2.fit(epochs)
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-ratio.hdf5'
+    ratio2.save(tmp_fname)
+
+    ratio2_read = read_ratio(tmp_fname, comment='nested')
+    assert_array_equal(ratio2_read.data_, ratio2.data_)
+    # The shared parent is read once
+    assert_true(ratio2_read.denominator is
+                ratio2_read.numerator.denominator)
+
+    markers = {}
+    read_ratio(tmp_fname, markers=markers, comment='nested')
+    assert_equal(sorted(markers), sorted(
+        [psd1._get_title(), psd2._get_title(), ratio._get_title()]))
+    ratio_read = read_ratio(tmp_fname, markers=markers,
+                            comment='delta_theta')
+    assert_true(ratio_read.numerator is markers[psd1._get_title()])
+
+    # So is the estimator shared by connectivity markers
+    csd_estimator = CrossSpectralEstimator(fmin=4., fmax=13.)
+    wpli1 = WeightedPhaseLagIndex(estimator=csd_estimator,
+                                  bands=((4., 8.),), comment='theta')
+    wpli2 = WeightedPhaseLagIndex(estimator=csd_estimator,
+                                  bands=((8., 13.),), comment='alpha')
+    ratio3 = Ratio(numerator=wpli1, denominator=wpli2, comment='wpli')
+    ratio3.fit(epochs)
+    tmp_fname = tmp + '/test-ratio-wpli.hdf5'
+    ratio3.save(tmp_fname)
+    ratio3_read = read_ratio(tmp_fname, comment='wpli')
+    assert_array_equal(ratio3_read.data_, ratio3.data_)
+    assert_true(ratio3_read.numerator.estimator is
+                ratio3_read.denominator.estimator)
+
+
+def test_ratio_storage():
+    """Test saving the PSD parents of Ratio markers with storage options"""
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+        comment='default')
+    psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4., comment='delta')
+    psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8., comment='theta')
+    ratio = Ratio(numerator=psd1, denominator=psd2, comment='delta_theta')
+    ratio.fit(epochs)
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-ratio-storage.hdf5'
+    storage = dict(compression='gzip', shuffle=True,
+                   chunks={'channels': 1}, dtype='float32')
+    ratio.save(tmp_fname, storage=storage)
+    with h5py.File(tmp_fname, 'r') as h5fid:
+        for psd in [psd1, psd2]:
+            data = h5fid[psd._get_title() + '/key_data_']
+            assert_equal(data.compression, 'gzip')
+            assert_equal(data.chunks, (len(epochs), 1, psd.data_.shape[2]))
+            assert_equal(data.dtype, np.float32)
+        # Saved by the PSD markers
+        if estimator._get_title() in h5fid:
+            data = h5fid[estimator._get_title() + '/key_data_']
+            assert_equal(data.compression, 'gzip')
+
+    ratio_read = read_ratio(tmp_fname, comment='delta_theta')
+    assert_array_almost_equal(ratio_read.data_, ratio.data_, decimal=4)
+    assert_array_almost_equal(ratio_read.numerator.data_, psd1.data_,
+                              decimal=4)
+
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__name__)
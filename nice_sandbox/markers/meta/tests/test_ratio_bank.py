@@ -0,0 +1,128 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+import numpy as np
+
+from numpy.testing import assert_array_almost_equal
+from nose.tools import assert_equal, assert_raises, assert_true
+
+import functools
+
+import mne
+from mne.utils import _TempDir
+
+from nice.utils import create_mock_data_egi
+from nice.markers.tests.test_markers import _base_io_test
+from nice.markers.spectral import (PowerSpectralDensity,
+                                   PowerSpectralDensityEstimator)
+
+from nice_sandbox import fit_markers
+from nice_sandbox.markers import save_markers
+from nice_sandbox.markers.meta import Ratio, RatioBank, read_ratio_bank
+
+n_epochs = 30
+raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
+
+triggers = np.arange(50, n_epochs * 386, 386)
+
+raw._data[-1].fill(0.0)
+raw._data[-1, triggers] = [10] * int(n_epochs / 2) + [20] * int(n_epochs / 2)
+
+events = mne.find_events(raw)
+event_id = {
+    'foo': 10,
+    'bar': 20,
+}
+epochs = mne.Epochs(raw, events, event_id, tmin=-.2, tmax=1.34,
+                    preload=True, reject=None, picks=None,
+                    baseline=(None, 0), verbose=False)
+epochs.drop_channels(['STI 014'])
+
+
+def test_ratio_bank():
+    """Test computation of RatioBank markers"""
+    psds_params = dict(n_fft=4096, n_overlap=100, n_jobs='auto',
+                       nperseg=128)
+    estimator = PowerSpectralDensityEstimator(
+        tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+        psd_params=psds_params, comment='default'
+    )
+    pairs = [((1., 4.), (4., 8.)), ((4., 8.), (8., 13.)),
+             ((8., 13.), (13., 30.))]
+    ratio_bank = RatioBank(estimator, pairs=pairs, comment='bank')
+    _base_io_test(ratio_bank, epochs,
+                  functools.partial(read_ratio_bank, comment='bank'))
+    assert_equal(ratio_bank.data_.shape, (len(epochs), 6, len(pairs)))
+
+    # Same as the ratios of the band power of PSD markers, with the edges
+    # of the bands on frequency bins
+    freqs = estimator.freqs_
+    pairs = [((freqs[0], freqs[2]), (freqs[2], freqs[5])),
+             ((freqs[2], freqs[5]), (freqs[5], freqs[6]))]
+    ratio_bank = RatioBank(estimator, pairs=pairs)
+    ratio_bank.fit(epochs)
+    red_psd = [{'axis': 'frequency', 'function': np.sum},
+               {'axis': 'channels', 'function': np.mean},
+               {'axis': 'epochs', 'function': np.mean}]
+    for i_pair, (numerator, denominator) in enumerate(pairs):
+        ratio = Ratio(
+            numerator=PowerSpectralDensity(
+                estimator, fmin=numerator[0], fmax=numerator[1], dB=False),
+            denominator=PowerSpectralDensity(
+                estimator, fmin=denominator[0], fmax=denominator[1],
+                dB=False))
+        ratio.fit(epochs)
+        assert_array_almost_equal(
+            ratio_bank.data_[..., i_pair].mean(axis=1),
+            ratio.reduce_to_epochs(reduction_func=red_psd))
+        assert_array_almost_equal(
+            ratio_bank.data_[..., i_pair].mean(axis=0),
+            ratio.reduce_to_topo(reduction_func=red_psd))
+
+    red_ratio = [{'axis': 'ratio', 'function': np.mean},
+                 {'axis': 'epochs', 'function': np.mean},
+                 {'axis': 'channels', 'function': np.mean}]
+    topos = ratio_bank.reduce_to_topo(reduction_func=red_ratio,
+                                      picks={'ratio': [1]})
+    assert_array_almost_equal(topos, ratio_bank.data_[..., 1].mean(axis=0))
+
+    # Banks that share an estimator share it when read
+    bank1 = RatioBank(estimator, pairs=pairs[:1], comment='bank1')
+    bank2 = RatioBank(estimator, pairs=pairs[1:], comment='bank2')
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-ratio-bank.hdf5'
+    save_markers(fit_markers([bank1, bank2], epochs), tmp_fname)
+    markers = {}
+    bank1_read = read_ratio_bank(tmp_fname, comment='bank1', markers=markers)
+    bank2_read = read_ratio_bank(tmp_fname, comment='bank2', markers=markers)
+    assert_true(bank1_read.estimator is bank2_read.estimator)
+    assert_array_almost_equal(bank1_read.data_, bank1.data_)
+    assert_array_almost_equal(bank2_read.data_, bank2.data_)
+
+    assert_raises(ValueError, RatioBank, estimator,
+                  pairs=[((4., 1.), (4., 8.))])
+    ratio_bank = RatioBank(estimator, pairs=[((100., 101.), (4., 8.))])
+    assert_raises(ValueError, ratio_bank.fit, epochs)
+
+
+if __name__ == "__main__":
+    import nose
+    nose.run(defaultTest=__name__)
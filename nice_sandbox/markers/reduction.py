@@ -0,0 +1,342 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import functools
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+import h5py
+
+from .base import _is_fitted
+
+# Reductions that can write into a preallocated array
+_OUT_FUNCS = (np.mean, np.sum, np.median, np.nanmean, np.nansum,
+              np.nanmedian, np.std, np.var, np.max, np.min)
+
+# Plans of each marker, dropped with the marker
+_plans = WeakKeyDictionary()
+
+# Plans kept per marker, the least recently used ones are dropped first
+_MAX_PLANS = 16
+
+# Upper bound for the slabs read by the reductions from disk
+_SLAB_BYTES = 64 * 1024 ** 2
+
+
+class ReductionPlan(object):
+    """Precomputed reduction of the data of a marker
+
+    The reduction functions are applied in order, each one directly on the
+    axis it reduces, so the data is never transposed. Intermediate results
+    of the numpy reductions that accept ``out`` are written into buffers
+    kept by the plan and reused by the next calls, so a plan must not be
+    used from several threads at once.
+
+    Parameters
+    ----------
+    axis_map : OrderedDict
+        The axis map of the marker.
+    reduction_func : list of dict | None
+        The reduction recipe, as for ``reduce_to_topo``. If None, all the
+        axes are averaged in the order of the axis map (epochs and channels
+        last if ``split``).
+    axis_to_preserve : list of str
+        The axes that are not reduced (e.g. ['channels'] for topographies).
+    split : bool
+        If True, the epochs and channels axes must be the last ones to be
+        reduced and the steps are split in ``pre_steps`` and
+        ``post_steps``, as needed by markers that combine other markers
+        after reducing them (e.g. ``Ratio``).
+    """
+
+    def __init__(self, axis_map, reduction_func, axis_to_preserve,
+                 split=False):
+        names = [name for name, _ in sorted(axis_map.items(),
+                                            key=lambda x: x[1])]
+        remaining = [x for x in names if x not in axis_to_preserve]
+        if reduction_func is None:
+            if split:
+                # Epochs and channels last
+                remaining.sort(key=lambda x: x in ['epochs', 'channels'])
+            steps = [(np.mean, x) for x in remaining]
+        else:
+            steps = [(rec['function'], rec['axis']) for rec in reduction_func
+                     if rec['axis'] not in axis_to_preserve]
+            if sorted(x for _, x in steps) != sorted(remaining):
+                raise ValueError('Run `python -c "import this"` to see '
+                                 'why we will not tolerate these things')
+
+        # Position of each axis in the array, as the previous ones are gone
+        current = list(names)
+        self.steps = []
+        for func, name in steps:
+            self.steps.append((func, current.index(name), name))
+            current.remove(name)
+        self.permutation = None
+        order = [current.index(x) for x in axis_to_preserve if x in current]
+        if order != sorted(order):
+            self.permutation = order
+
+        self.pre_steps, self.post_steps = self.steps, []
+        if split:
+            found = False
+            for _, _, name in self.steps:
+                if name in ['epochs', 'channels'] and found is False:
+                    found = True
+                if found is True and name not in ['epochs', 'channels']:
+                    raise ValueError(
+                        'Cannot reduce with this axis order. Channels and '
+                        'Epochs should be the two last axis to reduce (in '
+                        'any order).')
+            n_pre = len([x for x in self.steps
+                         if x[2] not in ['epochs', 'channels']])
+            self.pre_steps = self.steps[:n_pre]
+            self.post_steps = self.steps[n_pre:]
+        self._buffers = {}
+
+    def _apply(self, steps, data, offset, slot, final):
+        for i_step, (func, axis, _) in enumerate(steps):
+            axis += offset
+            if (final and i_step == len(steps) - 1) or \
+                    func not in _OUT_FUNCS or \
+                    not np.issubdtype(data.dtype, np.floating):
+                data = func(data, axis=axis)
+                continue
+            shape = data.shape[:axis] + data.shape[axis + 1:]
+            key = (slot, i_step, shape, data.dtype)
+            out = self._buffers.get(key, None)
+            if out is None:
+                out = np.empty(shape, dtype=data.dtype)
+                self._buffers[key] = out
+            data = func(data, axis=axis, out=out)
+        return data
+
+    def _finish(self, data, offset):
+        if self.permutation is not None:
+            data = np.transpose(
+                data, list(range(offset)) +
+                [offset + x for x in self.permutation])
+        return data
+
+    def reduce(self, data, offset=0):
+        """Apply all the steps
+
+        ``offset`` is the number of leading axes (e.g. subjects) that are
+        not part of the axis map and are kept.
+        """
+        data = self._apply(self.steps, data, offset, 0, True)
+        return self._finish(data, offset)
+
+    def reduce_pre(self, data, offset=0, slot=0):
+        """Apply the steps before epochs and channels
+
+        Inputs reduced one after the other must use a different ``slot``
+        so that they do not share buffers.
+        """
+        return self._apply(self.pre_steps, data, offset, slot,
+                           len(self.post_steps) == 0)
+
+    def reduce_post(self, data, offset=0):
+        """Apply the epochs and channels steps"""
+        data = self._apply(self.post_steps, data, offset, 'post', True)
+        return self._finish(data, offset)
+
+
+def _get_function_key(func):
+    """Key of a reduction function, by its contents
+
+    Lambdas and partials made again for each call get the same key as long
+    as they do the same thing.
+    """
+    if isinstance(func, functools.partial):
+        return ('partial', _get_function_key(func.func), func.args,
+                tuple(sorted(func.keywords.items())))
+    code = getattr(func, '__code__', None)
+    if code is None:
+        # Builtins and ufuncs
+        return func
+    closure = func.__closure__ or ()
+    return ('function', code, func.__defaults__,
+            tuple(cell.cell_contents for cell in closure))
+
+
+def _get_reduction_plan(marker, reduction_func, target, split=False):
+    """The cached reduction plan of a marker"""
+    axis_map = marker._axis_map
+    axis_to_preserve = marker._get_preserve_axis(target)
+    recipe = None
+    try:
+        if reduction_func is not None:
+            recipe = tuple((rec['axis'], _get_function_key(rec['function']))
+                           for rec in reduction_func)
+        key = (tuple(axis_map.items()), tuple(axis_to_preserve), recipe,
+               split)
+        plans = _plans.setdefault(marker, OrderedDict())
+        plan = plans.pop(key, None)
+    except (TypeError, ValueError):
+        # Unhashable reduction function (or an empty closure cell): no
+        # caching
+        return ReductionPlan(axis_map, reduction_func, axis_to_preserve,
+                             split=split)
+    if plan is None:
+        plan = ReductionPlan(axis_map, reduction_func, axis_to_preserve,
+                             split=split)
+        if len(plans) >= _MAX_PLANS:
+            plans.popitem(last=False)
+    # Most recently used last
+    plans[key] = plan
+    return plan
+
+
+def _reduce_split(plan, data, combine, offset=0):
+    """Reduce the inputs of a marker, combine them and reduce the result
+
+    ``data`` maps the name of each input to its data and ``combine`` takes
+    the dict of reduced inputs (e.g. numerator / denominator).
+    """
+    data = OrderedDict(
+        (name, plan.reduce_pre(x, offset=offset, slot=name))
+        for name, x in data.items())
+    return plan.reduce_post(combine(data), offset=offset)
+
+
+def _reduce_dataset(plan, dataset, axis_map, picks, axis_to_preserve,
+                    max_bytes=_SLAB_BYTES):
+    """Reduce data stored in a file, reading it slab by slab
+
+    The slabs are taken along the first preserved axis, which is not
+    reduced, or else along the last axis to be reduced, which is reduced
+    once all the other axes are reduced in each slab. Only one slab is in
+    memory at a time.
+    """
+    index = [np.arange(n) for n in dataset.shape]
+    if picks is not None:
+        if any([x not in axis_map for x in picks.keys()]):
+            raise ValueError('Picking is not compatible')
+        for axis, ax_picks in picks.items():
+            if axis in axis_to_preserve or ax_picks is None:
+                continue
+            index[axis_map[axis]] = index[axis_map[axis]][ax_picks]
+
+    steps, last_steps = plan.steps, []
+    if len(steps) == 0:
+        return plan.reduce(dataset.load()[np.ix_(*index)])
+    preserved = sorted(axis_map[x] for x in axis_to_preserve)
+    if len(preserved) > 0:
+        slab_axis = preserved[0]
+    else:
+        slab_axis = axis_map[steps[-1][2]]
+        steps, last_steps = steps[:-1], steps[-1:]
+    # The order along the slab axis is only kept if it is preserved
+    rows = np.sort(index[slab_axis])
+
+    row_bytes = dataset.dtype.itemsize * int(np.prod(
+        [n for i, n in enumerate(dataset.shape) if i != slab_axis]))
+    n_rows = max(1, max_bytes // max(1, row_bytes))
+    if dataset.chunks is not None and n_rows > dataset.chunks[slab_axis]:
+        # Whole chunks, so each one is read once
+        n_rows -= n_rows % dataset.chunks[slab_axis]
+
+    out = []
+    with h5py.File(str(dataset.fname), 'r') as h5fid:
+        h5data = h5fid[dataset.path]
+        for start in range(0, len(rows), n_rows):
+            these_rows = rows[start:start + n_rows]
+            first = these_rows[0]
+            selection = [slice(None)] * len(dataset.shape)
+            selection[slab_axis] = slice(first, these_rows[-1] + 1)
+            slab = h5data[tuple(selection)]
+            slab_index = list(index)
+            slab_index[slab_axis] = these_rows - first
+            slab = slab[np.ix_(*slab_index)]
+            out.append(plan._apply(steps, slab, 0, 'disk', True))
+    # The slab axis is the first one left
+    data = plan._apply(last_steps, np.concatenate(out, axis=0), 0, 'disk',
+                       True)
+    return plan._finish(data, 0)
+
+
+def _stack(data):
+    try:
+        return np.stack(data)
+    except ValueError:
+        raise ValueError('The markers data must have the same shape, got '
+                         '{}.'.format(sorted(set(x.shape for x in data))))
+
+
+def reduce_markers(markers, reduction_func=None, target='scalar',
+                   picks=None):
+    """Reduce the same marker of many subjects at once
+
+    The data of the markers are stacked along a new ``subjects`` axis and
+    reduced in one vectorized pass, with the same semantics as
+    ``reduce_to_topo``, ``reduce_to_scalar`` and ``reduce_to_epochs``
+    applied to each marker.
+
+    Parameters
+    ----------
+    markers : list of markers
+        The fitted markers, one per subject. They must be of the same class,
+        have the same axes and, once picked, data of the same shape.
+    reduction_func : list of dict | None
+        The reduction recipe, as for ``reduce_to_topo``.
+    target : 'scalar' | 'topography' | 'epochs'
+        What to reduce to.
+    picks : dict | None
+        The picks of each axis, as for ``reduce_to_topo``.
+
+    Returns
+    -------
+    out : ndarray, shape (n_subjects,) | (n_subjects, n_channels) | ...
+        The reduced data, subjects first.
+    """
+    markers = list(markers)
+    if len(markers) == 0:
+        raise ValueError('Need at least one marker to reduce.')
+    first = markers[0]
+    axis_map = list(first._axis_map.items())
+    for marker in markers[1:]:
+        if (type(marker) is not type(first) or
+                list(marker._axis_map.items()) != axis_map or
+                getattr(marker, 'expression', None) !=
+                getattr(first, 'expression', None)):
+            raise ValueError('All the markers must be of the same class '
+                             'and have the same axes.')
+    if not all(_is_fitted(marker) for marker in markers):
+        raise ValueError('All the markers must be fit.')
+
+    if hasattr(first, '_get_reduction_inputs'):
+        # Meta markers that combine other markers after reducing them
+        plan = _get_reduction_plan(first, reduction_func, target,
+                                   split=True)
+        inputs = [marker._get_reduction_inputs() for marker in markers]
+        data = OrderedDict(
+            (name, _stack([x[name]._prepare_data(picks, target)
+                           for x in inputs]))
+            for name in inputs[0])
+        return _reduce_split(plan, data, first._combine_reduced, offset=1)
+    plan = _get_reduction_plan(first, reduction_func, target)
+    data = _stack([marker._prepare_data(picks, target)
+                   for marker in markers])
+    return plan.reduce(data, offset=1)
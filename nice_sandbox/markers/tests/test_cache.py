@@ -0,0 +1,180 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import gc
+import glob
+import types
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_true
+
+import mne
+from mne.utils import _TempDir
+
+from nice_sandbox import fit_markers
+from nice_sandbox.markers import fit_cache
+from nice_sandbox.markers.connectivity import (WeightedPhaseLagIndex,
+                                               CrossSpectralEstimator,
+                                               read_wpli)
+from nice_sandbox.markers.meta import Ratio
+
+from nice.markers.spectral import PowerSpectralDensityEstimator
+from nice.tests.test_collection import _get_data
+from nice.utils import create_mock_data_egi
+
+
+def test_fit_cache():
+    """Test reusing the fits of markers from a cache directory"""
+    epochs = _get_data()[:2]
+    tmp = _TempDir()
+    with fit_cache(tmp) as cache:
+        wpli = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)))
+        wpli.fit(epochs)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 1)
+        key = cache.get_key(wpli, epochs)
+
+        wpli2 = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)))
+        assert_equal(cache.get_key(wpli2, epochs), key)
+        wpli2.fit(epochs)
+        assert_array_equal(wpli2.data_, wpli.data_)
+        assert_array_equal(wpli2.freqs_, wpli.freqs_)
+        assert_true(wpli2.ch_info_ is epochs.info)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 1)
+
+        # Other parameters, estimators or epochs are other fits
+        wpli3 = WeightedPhaseLagIndex(bands=((4., 8.),))
+        assert_true(cache.get_key(wpli3, epochs) != key)
+        wpli4 = WeightedPhaseLagIndex(
+            bands=((4., 8.), (8., 13.)),
+            estimator=CrossSpectralEstimator(fmin=2.))
+        assert_true(cache.get_key(wpli4, epochs) != key)
+        assert_true(cache.get_key(wpli, epochs[:1]) != key)
+        # Neither are the resources used to fit
+        wpli5 = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)), n_jobs=2,
+                                      max_memory='1M')
+        assert_equal(cache.get_key(wpli5, epochs), key)
+
+        # Meta markers are not cached, their parents are. The comment is
+        # not part of the key.
+        other = WeightedPhaseLagIndex(bands=((4., 8.), (8., 13.)),
+                                      comment='other')
+        ratio = Ratio(numerator=wpli2, denominator=other).fit(epochs)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 1)
+        assert_array_equal(other.data_, wpli.data_)
+        assert_array_equal(ratio.data_, wpli.data_ / wpli.data_)
+
+    # The least recently used fits are removed
+    with fit_cache(tmp, max_size=1):
+        wpli3.fit(epochs)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 0)
+    assert_equal(wpli3.data_.shape[-1], 1)
+
+
+def test_fit_cache_estimators():
+    """Test reusing the fits of estimators from a cache directory"""
+    epochs = _get_data()[:2]
+    tmp = _TempDir()
+    with fit_cache(tmp):
+        estimator = CrossSpectralEstimator().fit(epochs)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 1)
+        estimator2 = CrossSpectralEstimator()
+        # Not computed again
+        estimator2._fit = None
+        estimator2.fit(epochs)
+        assert_array_equal(estimator2.data_, estimator.data_)
+
+        # A cached marker gets its estimator fit
+        wpli = WeightedPhaseLagIndex(estimator=estimator).fit(epochs)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 2)
+        estimator3 = CrossSpectralEstimator()
+        wpli2 = WeightedPhaseLagIndex(estimator=estimator3).fit(epochs)
+        assert_array_equal(wpli2.data_, wpli.data_)
+        assert_array_equal(estimator3.data_, estimator.data_)
+        tmp_fname = tmp + '/test-wpli.h5'
+        wpli2.save(tmp_fname)
+        wpli_read = read_wpli(tmp_fname)
+        assert_array_equal(wpli_read.estimator.data_, estimator.data_)
+
+        # So are the PSD estimators of nice, fit by fit_markers
+        n_fits = [0]
+
+        def _counting_fit(self, epochs):
+            n_fits[0] += 1
+            return type(self).fit(self, epochs)
+
+        psd_estimators = []
+        for _ in range(2):
+            psd_estimator = PowerSpectralDensityEstimator(
+                tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+                psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+                comment='default')
+            psd_estimator.fit = types.MethodType(_counting_fit, psd_estimator)
+            fit_markers([psd_estimator], epochs)
+            psd_estimators.append(psd_estimator)
+        assert_equal(n_fits[0], 1)
+        assert_array_equal(psd_estimators[1].data_, psd_estimators[0].data_)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 3)
+
+
+def test_fit_cache_epochs():
+    """Test the keys of epochs that are not preloaded in a fit cache"""
+    n_epochs = 4
+    raw = create_mock_data_egi(6, n_epochs * 386, stim=True)
+    triggers = np.arange(50, n_epochs * 386, 386)
+    raw._data[-1].fill(0.0)
+    raw._data[-1, triggers] = 10
+    events = mne.find_events(raw)
+    epochs = mne.Epochs(raw, events, {'foo': 10}, tmin=-.2, tmax=1.34,
+                        preload=False, picks=mne.pick_types(raw.info,
+                                                            eeg=True),
+                        baseline=(None, 0), verbose=False)
+
+    # The data is read and hashed once per epochs object
+    n_reads = [0]
+
+    def _counting_get_data(self, *args, **kwargs):
+        n_reads[0] += 1
+        return type(self).get_data(self, *args, **kwargs)
+
+    epochs.get_data = types.MethodType(_counting_get_data, epochs)
+    tmp = _TempDir()
+    with fit_cache(tmp) as cache:
+        markers = [WeightedPhaseLagIndex(bands=((4., 8.),)),
+                   WeightedPhaseLagIndex(bands=((8., 13.),)),
+                   CrossSpectralEstimator()]
+        keys = [cache.get_key(marker, epochs) for marker in markers]
+        assert_equal(len(set(keys)), 3)
+        assert_equal(n_reads[0], 1)
+
+        markers[0].fit(epochs)
+        assert_true(not epochs.preload)
+        wpli = WeightedPhaseLagIndex(bands=((4., 8.),)).fit(epochs)
+        assert_array_equal(wpli.data_, markers[0].data_)
+        assert_equal(len(glob.glob(tmp + '/*.hdf5')), 1)
+
+        # The key is forgotten with the epochs
+        epochs_id = id(epochs)
+        assert_true(epochs_id in cache._epochs_keys)
+        del epochs
+        gc.collect()
+        assert_true(epochs_id not in cache._epochs_keys)
@@ -21,7 +21,12 @@
 # applications.
 
 
-from nose.tools import assert_equal, assert_true
+from nose.tools import assert_equal, assert_true, assert_raises
+from numpy.testing import assert_array_almost_equal
+
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
 
 from mne.utils import _TempDir
 
@@ -31,7 +36,13 @@ from nice.markers import ContingentNegativeVariation
 from nice.markers import PermutationEntropy
 from nice.markers import PowerSpectralDensityEstimator
 
-from nice_sandbox.markers.connectivity import WeightedPhaseLagIndex
+from nice_sandbox.markers.connectivity import (WeightedPhaseLagIndex,
+                                               PhaseLockingValue,
+                                               CrossSpectralEstimator)
+from nice_sandbox.markers.connectivity import read_wpli
+from nice_sandbox.markers.meta import Ratio, Passthrough, read_passthrough
+from nice_sandbox.markers import save_markers, HDF5Writer
+from nice_sandbox import fit_markers, collection, utils
 
 from nice import Markers, read_markers
 
@@ -92,6 +103,104 @@ def test_collecting_feature():
     assert_true(wpli._get_title() in markers3)
 
 
+def test_fit_markers():
+    """Test fitting markers following their dependencies"""
+    epochs = _get_data()[:2]
+    estimator = CrossSpectralEstimator()
+    wpli = WeightedPhaseLagIndex(estimator=estimator)
+    plv = PhaseLockingValue(estimator=estimator)
+    ratio = Ratio(numerator=wpli, denominator=plv)
+    passthrough = Passthrough(parent=ratio)
+
+    # Meta markers before their parents
+    markers = Markers([passthrough, ratio, plv, wpli])
+    fit_markers(markers, epochs, n_jobs=2)
+    for t_marker in [estimator, wpli, plv]:
+        assert_true(any(k.endswith('_') for k in vars(t_marker)))
+
+    wpli2 = WeightedPhaseLagIndex().fit(epochs)
+    assert_array_almost_equal(wpli.data_, wpli2.data_)
+    assert_array_almost_equal(passthrough.data_, wpli.data_ / plv.data_)
+
+
+def test_fit_markers_auto():
+    """Test the number of markers fit at once with n_jobs='auto'"""
+    epochs = _get_data()[:2]
+    estimator = CrossSpectralEstimator()
+    markers = [WeightedPhaseLagIndex(estimator=estimator, comment='shared'),
+               PhaseLockingValue(estimator=estimator, comment='shared')]
+    markers += [WeightedPhaseLagIndex(fmin=fmin, fmax=fmin + 4.,
+                                      comment=str(fmin))
+                for fmin in (4., 8., 12.)]
+
+    # 8 CPUs, and a BLAS pool that uses them all
+    n_workers = []
+
+    class _Executor(ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            n_workers.append(max_workers)
+            ThreadPoolExecutor.__init__(self, max_workers=max_workers)
+
+    patched = dict(
+        get_cpu_count=lambda: 8,
+        get_thread_pools=lambda: [{'user_api': 'blas', 'num_threads': 8}])
+    originals = {k: getattr(utils, k) for k in patched}
+    executor = collection.ThreadPoolExecutor
+    try:
+        for key, value in patched.items():
+            setattr(utils, key, value)
+        collection.ThreadPoolExecutor = _Executor
+        fit_markers(markers, epochs)
+    finally:
+        for key, value in originals.items():
+            setattr(utils, key, value)
+        collection.ThreadPoolExecutor = executor
+    # The estimator and the 3 markers without dependencies
+    assert_equal(n_workers, [4])
+    for marker in markers:
+        assert_true(hasattr(marker, 'data_'))
+
+
+def test_save_markers():
+    """Test saving markers with shared dependencies to one file"""
+    epochs = _get_data()[:2]
+    estimator = CrossSpectralEstimator()
+    wpli = WeightedPhaseLagIndex(estimator=estimator)
+    plv = PhaseLockingValue(estimator=estimator)
+    ratio = Ratio(numerator=wpli, denominator=plv)
+    passthrough = Passthrough(parent=ratio)
+    fit_markers([passthrough], epochs)
+
+    tmp = _TempDir()
+    tmp_fname = tmp + '/test-markers.hdf5'
+    save_markers([passthrough, wpli], tmp_fname)
+    assert_raises(IOError, save_markers, [wpli], tmp_fname)
+    with h5py.File(tmp_fname, 'r') as h5fid:
+        for marker in [estimator, wpli, plv, ratio, passthrough]:
+            assert_true(marker._get_title() in h5fid)
+        assert_true('nice/data/ch_info' in h5fid)
+
+    wpli2 = read_wpli(tmp_fname)
+    assert_array_almost_equal(wpli2.data_, wpli.data_)
+    assert_array_almost_equal(wpli2.estimator.data_, estimator.data_)
+    markers = {x._get_title(): x for x in [wpli, plv, ratio]}
+    passthrough2 = read_passthrough(tmp_fname, markers=markers)
+    assert_array_almost_equal(passthrough2.data_, passthrough.data_)
+    # The channel info is read once
+    assert_true(wpli2.ch_info_ is passthrough2.ch_info_)
+    assert_true(wpli2.ch_info_ is wpli2.estimator.ch_info_)
+
+    # Markers are written once, whatever the number of references
+    with HDF5Writer(tmp_fname, overwrite=True) as writer:
+        writer.add(ratio).add(wpli).add(ratio)
+        assert_equal(len(writer._queue), 4)
+    with h5py.File(tmp_fname, 'r') as h5fid:
+        assert_true(passthrough._get_title() not in h5fid)
+        assert_true(ratio._get_title() in h5fid)
+    # and again if the file changed
+    assert_true(read_wpli(tmp_fname).ch_info_ is not wpli2.ch_info_)
+
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__name__)
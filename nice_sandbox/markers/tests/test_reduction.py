@@ -0,0 +1,86 @@
+# NICE-Sandbox
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+from nose.tools import assert_equal, assert_raises
+
+from nice.markers import PowerSpectralDensity
+from nice.markers import PowerSpectralDensityEstimator
+
+from nice_sandbox.markers import reduce_markers
+from nice_sandbox.markers.connectivity import WeightedPhaseLagIndex
+from nice_sandbox.markers.meta import Ratio
+
+from nice.tests.test_collection import _get_data
+
+
+def _get_subjects(n_subjects=3):
+    # Overlapping chunks of the same number of epochs
+    epochs = _get_data()
+    return [epochs[i_subject:i_subject + 2]
+            for i_subject in range(n_subjects)]
+
+
+def test_reduce_markers():
+    """Test reducing markers of many subjects at once"""
+    ratios, wplis = [], []
+    for epochs in _get_subjects():
+        estimator = PowerSpectralDensityEstimator(
+            tmin=None, tmax=None, fmin=1., fmax=45., psd_method='welch',
+            psd_params=dict(n_fft=4096, n_overlap=100, nperseg=128),
+            comment='default')
+        psd1 = PowerSpectralDensity(estimator, fmin=1., fmax=4.,
+                                    comment='delta')
+        psd2 = PowerSpectralDensity(estimator, fmin=4., fmax=8.,
+                                    comment='theta')
+        ratios.append(Ratio(numerator=psd1, denominator=psd2).fit(epochs))
+        wplis.append(WeightedPhaseLagIndex().fit(epochs))
+
+    red_ratio = [{'axis': 'frequency', 'function': np.sum},
+                 {'axis': 'epochs', 'function': np.median},
+                 {'axis': 'channels', 'function': np.mean}]
+    topos = reduce_markers(ratios, red_ratio, target='topography')
+    assert_equal(topos.shape, (len(ratios), ratios[0].numerator.data_.shape[
+        ratios[0]._axis_map['channels']]))
+    for topo, ratio in zip(topos, ratios):
+        assert_array_almost_equal(
+            topo, ratio.reduce_to_topo(reduction_func=red_ratio))
+    scalars = reduce_markers(ratios, red_ratio, target='scalar')
+    for scalar, ratio in zip(scalars, ratios):
+        assert_array_almost_equal(
+            scalar, ratio.reduce_to_scalar(reduction_func=red_ratio))
+
+    red_wpli = [{'axis': 'channels_y', 'function': np.median},
+                {'axis': 'channels', 'function': np.mean}]
+    topos = reduce_markers(wplis, red_wpli, target='topography')
+    for topo, wpli in zip(topos, wplis):
+        assert_array_almost_equal(
+            topo, wpli.reduce_to_topo(reduction_func=red_wpli))
+
+    assert_raises(ValueError, reduce_markers, [ratios[0], wplis[0]])
+    assert_raises(ValueError, reduce_markers, [])
+
+
+if __name__ == "__main__":
+    import nose
+    nose.run(defaultTest=__name__)
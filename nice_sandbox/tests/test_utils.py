@@ -0,0 +1,105 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import os
+import subprocess
+import sys
+import threading
+
+from nose.tools import assert_equal, assert_true, assert_raises
+from nose.plugins.skip import SkipTest
+
+from nice_sandbox.utils import (get_cpu_count, get_thread_pools,
+                                plan_execution, limit_threads)
+
+
+def test_plan_execution():
+    """Test the choice of processes and threads"""
+    n_cpus = get_cpu_count()
+    assert_true(n_cpus >= 1)
+
+    for n_jobs in ('auto', 1, 2, -1):
+        n_procs, n_threads = plan_execution(n_jobs)
+        assert_true(n_procs >= 1)
+        assert_true(n_threads >= 1)
+        assert_true(n_procs * n_threads <= max(n_cpus, n_procs))
+
+    assert_equal(plan_execution(-1)[0], n_cpus)
+    assert_equal(plan_execution(1), (1, n_cpus))
+    assert_equal(plan_execution(-1, n_tasks=1), (1, n_cpus))
+    assert_raises(ValueError, plan_execution, 0)
+
+
+def test_limit_threads():
+    """Test capping the thread pools"""
+    with limit_threads(1):
+        for pool in get_thread_pools():
+            assert_equal(pool['num_threads'], 1)
+
+    # The processes started within the block get the limit
+    environ = dict(os.environ)
+    code = 'import os; print(os.environ["OPENBLAS_NUM_THREADS"])'
+    with limit_threads(2):
+        with limit_threads(3):
+            assert_equal(os.environ['OMP_NUM_THREADS'], '2')
+            out = subprocess.check_output([sys.executable, '-c', code])
+    assert_equal(out.decode().strip(), '2')
+    assert_equal(dict(os.environ), environ)
+
+
+def test_limit_threads_concurrent():
+    """Test capping the thread pools from several threads"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        raise SkipTest('threadpoolctl is not installed')
+    # Concurrent blocks keep the limit until the last one exits
+    entered = threading.Barrier(2)
+    first_exited = threading.Event()
+    n_threads = []
+
+    def _run(first):
+        with limit_threads(1):
+            entered.wait()
+            if not first:
+                first_exited.wait()
+                n_threads.extend(pool['num_threads']
+                                 for pool in get_thread_pools())
+        if first:
+            first_exited.set()
+
+    # More than one thread per pool, to see the limit
+    with threadpool_limits(limits=2):
+        threads = [threading.Thread(target=_run, args=(first,))
+                   for first in (True, False)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_true(all(x == 1 for x in n_threads))
+        assert_true(all(pool['num_threads'] == 2
+                        for pool in get_thread_pools()))
+
+
+if __name__ == "__main__":
+    import nose
+    nose.run(defaultTest=__name__)
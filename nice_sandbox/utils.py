@@ -0,0 +1,210 @@
+# NICE
+# Copyright (C) 2017 - Authors of NICE-sandbox
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+from mne.utils import logger
+
+# Number of limit_threads blocks being run, in any thread, and the limiter
+# and environment of the first one, which are restored when the last one
+# exits
+_thread_limit = [0, None, None]
+_thread_limit_lock = threading.Lock()
+
+# Thread pool sizes of the processes started within limit_threads
+_THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS')
+
+
+def _get_cgroup_cpu_quota():
+    """CPU quota of the cgroup of this process, None if unlimited"""
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as fid:
+            quota, period = fid.read().split()[:2]
+        if quota == 'max':
+            return None
+        return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    for path in ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct'):
+        try:
+            with open(os.path.join(path, 'cpu.cfs_quota_us'), 'r') as fid:
+                quota = float(fid.read())
+            with open(os.path.join(path, 'cpu.cfs_period_us'), 'r') as fid:
+                period = float(fid.read())
+        except (OSError, ValueError):
+            continue
+        if quota > 0 and period > 0:
+            return quota / period
+        return None
+    return None
+
+
+def get_cpu_count():
+    """Number of CPUs this process can use
+
+    Honours the CPU affinity of the process and the CPU quota of its cgroup
+    (e.g. in containers), which ``os.cpu_count`` ignores.
+
+    Returns
+    -------
+    n_cpus : int
+        The number of usable CPUs.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+    quota = _get_cgroup_cpu_quota()
+    if quota is not None:
+        n_cpus = min(n_cpus, int(math.ceil(quota)))
+    return max(n_cpus, 1)
+
+
+def get_thread_pools():
+    """Active BLAS and OpenMP thread pools
+
+    Returns
+    -------
+    pools : list of dict
+        The ``threadpoolctl.threadpool_info()`` of the process, with the
+        ``user_api`` ('blas' or 'openmp') and ``num_threads`` of each pool.
+        Empty if threadpoolctl is not installed.
+    """
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        return []
+    return threadpool_info()
+
+
+def plan_execution(n_jobs='auto', n_tasks=None):
+    """Choose the number of processes and of threads per process
+
+    Parameters
+    ----------
+    n_jobs : int | 'auto'
+        The number of processes. Negative values count back from the number
+        of CPUs (-1 uses all of them). If 'auto', each process keeps the
+        threads of the current BLAS pool and the CPUs are split among as
+        many processes as fit.
+    n_tasks : int | None
+        The number of tasks that can run in parallel. No more processes are
+        used, and the CPUs left go to the threads of each process.
+
+    Returns
+    -------
+    n_procs : int
+        The number of processes.
+    n_threads : int
+        The number of BLAS/OpenMP threads for each process, so that
+        ``n_procs * n_threads`` does not exceed the number of CPUs.
+    """
+    n_cpus = get_cpu_count()
+    if n_jobs == 'auto':
+        blas_threads = [pool['num_threads'] for pool in get_thread_pools()
+                        if pool['user_api'] == 'blas']
+        n_threads = min(max(blas_threads + [1]), n_cpus)
+        n_procs = max(n_cpus // n_threads, 1)
+        logger.info('Autodetected number of jobs {}'.format(n_procs))
+    else:
+        n_procs = int(n_jobs)
+        if n_procs == 0:
+            raise ValueError('n_jobs cannot be 0.')
+        if n_procs < 0:
+            n_procs = max(n_cpus + 1 + n_procs, 1)
+    if n_tasks is not None:
+        n_procs = max(min(n_procs, n_tasks), 1)
+    n_threads = max(n_cpus // n_procs, 1)
+    return n_procs, n_threads
+
+
+@contextmanager
+def limit_threads(n_threads):
+    """Cap the BLAS and OpenMP thread pools within a block
+
+    The pools are global to the process, so nested and concurrent calls
+    (e.g. from markers fit in several threads) keep the limit of the first
+    one until the last one exits. The processes started within the block
+    (e.g. the joblib workers of mne) get the same limit, through the
+    ``OMP_NUM_THREADS``, ``OPENBLAS_NUM_THREADS``, ``MKL_NUM_THREADS``...
+    environment variables. The pools of this process are only capped if
+    threadpoolctl is installed.
+
+    Parameters
+    ----------
+    n_threads : int
+        The maximum number of threads of each pool.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+    with _thread_limit_lock:
+        if _thread_limit[0] == 0:
+            if threadpool_limits is not None:
+                _thread_limit[1] = threadpool_limits(limits=n_threads)
+            _thread_limit[2] = {k: os.environ.get(k)
+                                for k in _THREAD_ENV_VARS}
+            os.environ.update({k: str(n_threads) for k in _THREAD_ENV_VARS})
+        _thread_limit[0] += 1
+    try:
+        yield
+    finally:
+        with _thread_limit_lock:
+            _thread_limit[0] -= 1
+            if _thread_limit[0] == 0:
+                if _thread_limit[1] is not None:
+                    _thread_limit[1].restore_original_limits()
+                for key, value in _thread_limit[2].items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+                _thread_limit[1] = _thread_limit[2] = None
+
+
+def _parse_memory(max_memory):
+    """Number of bytes of a memory size such as 2G, '512M' or 1e9"""
+    if isinstance(max_memory, str):
+        units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                 'T': 1024 ** 4}
+        value = max_memory.strip().upper()
+        if value.endswith('B'):
+            value = value[:-1]
+        unit = value[-1:] if value[-1:] in units else ''
+        try:
+            n_bytes = float(value[:len(value) - len(unit)]) * units[unit]
+        except ValueError:
+            raise ValueError('Invalid memory size: {}'.format(max_memory))
+    else:
+        n_bytes = float(max_memory)
+    if not n_bytes > 0:
+        raise ValueError('The memory size must be positive, got {}.'.format(
+            max_memory))
+    return int(n_bytes)